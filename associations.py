@@ -1,15 +1,181 @@
-from collections import defaultdict
+from array import array
+from collections import defaultdict, Counter
+from itertools import chain, ifilter
 from utils import average
 
 
-class Associations(defaultdict):
+def _lowest_bit(word):
+    return (word & -word).bit_length() - 1
 
-    def __init__(self, k_list):
+
+class FreeGroups:
+    '''Bitmap of the full groups of a fragment, able to find the next non-full group.
+
+    Every word holds 64 groups, and a summary bitmap marks the words that are
+    completely full so that long runs of full groups are skipped 4096 at a time.'''
+
+    BITS = 64
+    MASK = (1 << BITS) - 1
+
+    def __init__(self):
+        self._words = []
+        self._summary = []
+
+    def __contains__(self, group_id):
+        word, bit = divmod(group_id, self.BITS)
+        return 0 <= word < len(self._words) and bool(self._words[word] >> bit & 1)
+
+    def add(self, group_id):
+        word, bit = divmod(group_id, self.BITS)
+        if word >= len(self._words):
+            self._words.extend([0] * (word + 1 - len(self._words)))
+            self._summary.extend([0] * (word // self.BITS + 1 - len(self._summary)))
+        self._words[word] |= 1 << bit
+        if self._words[word] == self.MASK:
+            self._summary[word // self.BITS] |= 1 << (word % self.BITS)
+
+    def remove(self, group_id):
+        word, bit = divmod(group_id, self.BITS)
+        self._words[word] &= ~(1 << bit)
+        self._summary[word // self.BITS] &= ~(1 << (word % self.BITS))
+
+    def next_free(self, group_id):
+        '''returns the first non-full group greater or equal than group_id'''
+        word, bit = divmod(max(group_id, 0), self.BITS)
+        if word >= len(self._words):
+            return max(group_id, 0)
+        free = ~self._words[word] & self.MASK & ~((1 << bit) - 1)
+        if free:
+            return word * self.BITS + _lowest_bit(free)
+
+        # look for the next word which is not completely full
+        summary, bit = divmod(word + 1, self.BITS)
+        while summary < len(self._summary):
+            free = ~self._summary[summary] & self.MASK & ~((1 << bit) - 1)
+            if free:
+                word = summary * self.BITS + _lowest_bit(free)
+                if word >= len(self._words):
+                    break
+                return word * self.BITS + _lowest_bit(~self._words[word] & self.MASK)
+            summary, bit = summary + 1, 0
+        return len(self._words) * self.BITS
+
+
+class PairIndex:
+    '''Reference-counted adjacency between the groups of every pair of fragments'''
+
+    def __init__(self, columns):
+        self._edges = [[defaultdict(Counter) for _ in xrange(columns)] for _ in xrange(columns)]
+
+    def added(self, row_id, association):
+        for fragment1, group1 in enumerate(association):
+            for fragment2, group2 in enumerate(association):
+                if fragment1 != fragment2:
+                    self._edges[fragment1][fragment2][group1][group2] += 1
+
+    def removed(self, row_id, association):
+        for fragment1, group1 in enumerate(association):
+            for fragment2, group2 in enumerate(association):
+                if fragment1 != fragment2:
+                    edges = self._edges[fragment1][fragment2]
+                    edges[group1][group2] -= 1
+                    if not edges[group1][group2]:
+                        del edges[group1][group2]
+                        if not edges[group1]:
+                            del edges[group1]
+
+    def exists(self, fragment1, group1, fragment2, group2):
+        return group2 in self._edges[fragment1][fragment2].get(group1, ())
+
+
+class SizeBuckets:
+    '''The non-full groups of a fragment bucketed by size, in arrays.
+
+    The position of every group in its bucket is kept, so that a group leaves its
+    bucket by taking the place of the last one. The groups never used, from seen
+    on, are left out.'''
+
+    def __init__(self, k):
+        self._buckets = [array('i') for _ in xrange(k)]
+        self._positions = array('i')
+        self.seen = 0
+
+    def __getitem__(self, size):
+        return self._buckets[size]
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def resized(self, group_id, old, new):
+        '''move group_id from the bucket of its old size to the one of its new size'''
+        if group_id >= self.seen:
+            self._positions.extend(array('i', [-1]) * (group_id + 1 - self.seen))
+            for skipped in xrange(self.seen, group_id):
+                self._add(skipped, 0)
+            self.seen = group_id + 1
+        elif old < len(self._buckets):
+            self._remove(group_id, old)
+        if new < len(self._buckets):
+            self._add(group_id, new)
+
+    def _add(self, group_id, size):
+        bucket = self._buckets[size]
+        self._positions[group_id] = len(bucket)
+        bucket.append(group_id)
+
+    def _remove(self, group_id, size):
+        bucket = self._buckets[size]
+        position, last = self._positions[group_id], bucket.pop()
+        if last != group_id:
+            bucket[position] = last
+            self._positions[last] = position
+
+
+class BaseAssociations:
+    '''Methods shared by the association stores, which keep the full groups of
+    every fragment in self._fulls and the non-full ones in self._buckets'''
+
+    def is_group_full(self, fragment_id, group_id):
+        return group_id in self._fulls[fragment_id]
+
+    def next_nonfull_group(self, fragment_id, group_id):
+        return self._fulls[fragment_id].next_free(group_id)
+
+    def iter_nonfull_groups(self, fragment_id, start, stop):
+        '''returns the non-full groups in [start, stop) in ascending order'''
+        group_id = self._fulls[fragment_id].next_free(start)
+        while group_id < stop:
+            yield group_id
+            group_id = self._fulls[fragment_id].next_free(group_id + 1)
+
+    def iter_nonfull_groups_by_size(self, fragment_id, start, stop, fullest=False):
+        '''returns the non-full groups in [start, stop) from the emptiest, or from the fullest.
+        The empty groups come last either way, or no group would ever be filled'''
+        buckets = self._buckets[fragment_id]
+        nonempty = [buckets[size] for size in xrange(1, len(buckets))]
+        empty = chain(buckets[0], xrange(max(start, buckets.seen), stop))
+        for bucket in chain(reversed(nonempty) if fullest else nonempty, [empty]):
+            for group_id in bucket:
+                if start <= group_id < stop:
+                    yield group_id
+
+    def get_average_group_size(self):
+        return average(map(self.get_average_group_size_in_fragment, xrange(self._columns)))
+
+
+
+class Associations(BaseAssociations, defaultdict):
+    '''Associations of the rows, with the adjacency of the groups in self._pairs'''
+
+    def __init__(self, k_list, listeners=()):
         defaultdict.__init__(self, tuple)
-        self._k_list  = k_list
-        self._columns = len(self._k_list)
-        self._indices = [defaultdict(set) for _ in xrange(self._columns)]
-        self._fulls   = [set() for _ in xrange(self._columns)]
+        self._k_list    = k_list
+        self._columns   = len(self._k_list)
+        self._indices   = [defaultdict(set) for _ in xrange(self._columns)]
+        self._fulls     = [FreeGroups() for _ in xrange(self._columns)]
+        self._buckets   = [SizeBuckets(k) for k in self._k_list]
+        self._pairs     = PairIndex(self._columns)
+        self._listeners = [self._pairs] + list(listeners)
 
     def __setitem__(self, key, val):
         if val and len(val) != self._columns:
@@ -20,22 +186,27 @@ class Associations(defaultdict):
             group = self._indices[i][v]
             group.add(key)
             size = len(group)
+            self._buckets[i].resized(v, size - 1, size)
             if size == self._k_list[i]:
                 self._fulls[i].add(v)
+        if val:
+            for listener in self._listeners:
+                listener.added(key, val)
 
     def __delitem__(self, key):
         if key in self:
+            if self[key]:
+                for listener in self._listeners:
+                    listener.removed(key, self[key])
             for i, v in enumerate(self[key]):
                 group = self._indices[i][v]
                 size = len(group)
                 if size == self._k_list[i]:
                     self._fulls[i].remove(v)
                 group.remove(key)
+                self._buckets[i].resized(v, size, size - 1)
             defaultdict.__delitem__(self, key)
 
-    def is_group_full(self, fragment_id, group_id):
-        return group_id in self._fulls[fragment_id]
-
     def get_group(self, fragment_id, group_id):
         return self._indices[fragment_id][group_id].copy()
 
@@ -45,14 +216,134 @@ class Associations(defaultdict):
     def get_groups(self, fragment_id):
         return self._indices[fragment_id]
 
+    def iter_groups(self, fragment_id):
+        return self._indices[fragment_id].iteritems()
+
     def get_average_group_size_in_fragment(self, fragment_id):
         return average(map(len, filter(None, self._indices[fragment_id].values())))
 
-    def get_average_group_size(self):
-        return average(map(self.get_average_group_size_in_fragment, xrange(self._columns)))
-
     def get_associated(self, fragment_id, group_id, select=slice(None)):
         return (self[key][select] for key in self._indices[fragment_id][group_id])
 
     def exists(self, fragment1, group1, fragment2, group2):
-        return group1 in self.get_associated(fragment2, group2, fragment1)
+        return self._pairs.exists(fragment2, group2, fragment1, group1)
+
+
+class CompactAssociations(BaseAssociations):
+    '''Associations with the same interface, stored in flat arrays.
+
+    The associations are kept in a rows x fragments matrix of int32 (-1 when
+    the row is not associated), the members of every group in a growable array
+    and the full groups of every fragment in a FreeGroups bitmap. No adjacency of
+    the groups is kept: exists scans the members of a group.'''
+
+    def __init__(self, k_list, rows, listeners=()):
+        self._k_list    = k_list
+        self._columns   = len(self._k_list)
+        self._rows      = rows
+        self._matrix    = array('i', [-1]) * (rows * self._columns)
+        self._members   = [[] for _ in xrange(self._columns)]
+        self._fulls     = [FreeGroups() for _ in xrange(self._columns)]
+        self._buckets   = [SizeBuckets(k) for k in self._k_list]
+        self._length    = 0
+        self._listeners = list(listeners)
+
+    def _grow(self, fragment_id, group_id):
+        members = self._members[fragment_id]
+        if group_id >= len(members):
+            members.extend(array('i') for _ in xrange(group_id + 1 - len(members)))
+        return members[group_id]
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, key):
+        return 0 <= key < self._rows and self._matrix[key * self._columns] != -1
+
+    def __getitem__(self, key):
+        if key not in self:
+            return ()
+        start = key * self._columns
+        return tuple(self._matrix[start:start + self._columns])
+
+    def __setitem__(self, key, val):
+        if val and len(val) != self._columns:
+            raise ValueError('wrong value length for %s. Expected %i' % (val, self._columns))
+        del self[key]
+        if not val:
+            return
+        self._matrix[key * self._columns:(key + 1) * self._columns] = array('i', val)
+        self._length += 1
+        for i, v in enumerate(val):
+            group = self._grow(i, v)
+            group.append(key)
+            self._buckets[i].resized(v, len(group) - 1, len(group))
+            if len(group) == self._k_list[i]:
+                self._fulls[i].add(v)
+        for listener in self._listeners:
+            listener.added(key, tuple(val))
+
+    def __delitem__(self, key):
+        if key in self:
+            val = self[key]
+            for listener in self._listeners:
+                listener.removed(key, val)
+            for i, v in enumerate(val):
+                group = self._members[i][v]
+                if len(group) == self._k_list[i]:
+                    self._fulls[i].remove(v)
+                group.remove(key)
+                self._buckets[i].resized(v, len(group) + 1, len(group))
+            self._matrix[key * self._columns] = -1
+            self._length -= 1
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def iterkeys(self):
+        return (key for key in xrange(self._rows) if key in self)
+
+    def itervalues(self):
+        return (self[key] for key in self.iterkeys())
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self.iterkeys())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def _group(self, fragment_id, group_id):
+        members = self._members[fragment_id]
+        return members[group_id] if 0 <= group_id < len(members) else ()
+
+    def get_group(self, fragment_id, group_id):
+        return set(self._group(fragment_id, group_id))
+
+    def get_group_size(self, fragment_id, group_id):
+        return len(self._group(fragment_id, group_id))
+
+    def get_groups(self, fragment_id):
+        return dict(self.iter_groups(fragment_id))
+
+    def iter_groups(self, fragment_id):
+        return ifilter(lambda (group_id, rows): rows, enumerate(self._members[fragment_id]))
+
+    def get_average_group_size_in_fragment(self, fragment_id):
+        return average(filter(None, map(len, self._members[fragment_id])))
+
+    def get_associated(self, fragment_id, group_id, select=slice(None)):
+        return (self[key][select] for key in self._group(fragment_id, group_id))
+
+    def exists(self, fragment1, group1, fragment2, group2):
+        # the members of a group are scanned, a pair index would outweigh the matrix
+        columns, matrix = self._columns, self._matrix
+        return any(matrix[key * columns + fragment1] == group1 for key in self._group(fragment2, group2))
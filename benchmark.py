@@ -0,0 +1,140 @@
+from exporter import Exporter
+from itertools import product
+from loose import Loose
+from multiprocessing import Process, Queue
+from tables import RandomTable, SelfSimilarTable, GaussianTable
+from time import time
+import resource
+import random
+import os
+import logging
+import json
+
+
+DISTRIBUTIONS = {'random': RandomTable, 'selfsimilar': SelfSimilarTable, 'gaussian': GaussianTable}
+
+DEFAULT_SPEC = {
+    'sizes': [1000, 5000],
+    'attrs': [4],
+    'distributions': ['random', 'selfsimilar', 'gaussian'],
+    'fragments': [[[0, 2], [1, 3]]],
+    'constraints': [[[0, 1], [2, 3]]],
+    'k_lists': [[2, 2], [3, 3]],
+    'seed': 0,
+    'table_cache': None,    # directory where the generated tables are stored (needs numpy)
+}
+
+# the metrics compared between two result files, with the direction of an improvement
+METRICS = {'rows_per_second': 1, 'export_seconds': -1, 'operations': -1, 'dropped': -1, 'peak_memory_kb': -1}
+
+
+def configurations(spec):
+    '''returns every combination of the parameters in spec which makes sense'''
+    for tuples, attrs, distribution, fragments, constraints, k_list in product(
+            spec['sizes'], spec['attrs'], spec['distributions'], spec['fragments'], spec['constraints'], spec['k_lists']):
+        used = set(a for attributes in fragments + constraints for a in attributes)
+        if max(used) < attrs and len(k_list) == len(fragments):
+            yield dict(tuples=tuples, attrs=attrs, distribution=distribution, fragments=fragments,
+                       constraints=constraints, k_list=k_list, seed=spec.get('seed', 0))
+
+
+def key(configuration):
+    '''returns a hashable identifier of a configuration'''
+    return json.dumps(configuration, sort_keys=True)
+
+
+def measure(configuration, cache=None):
+    '''associate and export a generated table, returning the measures. With a cache
+    directory, the generated tables are stored there and reused by the next runs.'''
+    random.seed(configuration['seed'])
+    path = None
+    if cache is not None:
+        path = os.path.join(cache, '{distribution}_{tuples}_{attrs}_{seed}.npy'.format(**configuration))
+    table = DISTRIBUTIONS[configuration['distribution']](configuration['tuples'], configuration['attrs'],
+                                                         seed=configuration['seed'], path=path)
+    loose = Loose(table, configuration['constraints'], configuration['fragments'])
+
+    started = time()
+    associations, dropped = loose.associate(configuration['k_list'])
+    associated = time()
+    Exporter(table, configuration['fragments'], associations).to_sqlite(':memory:')
+    exported = time()
+
+    return dict(associate_seconds=associated - started,
+                rows_per_second=configuration['tuples'] / max(associated - started, 1e-9),
+                export_seconds=exported - associated,
+                operations=loose.operations,
+                dropped=len(dropped),
+                peak_memory_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def _measure_in(queue, configuration, cache):
+    # the association logs every dropped row and stack operation
+    logging.disable(logging.INFO)
+    queue.put(measure(configuration, cache))
+
+
+def run(spec):
+    '''measure every configuration of spec, each one in its own process to isolate the peak memory'''
+    results = []
+    for configuration in configurations(spec):
+        logging.info('running %s' % key(configuration))
+        queue = Queue()
+        process = Process(target=_measure_in, args=(queue, configuration, spec.get('table_cache')))
+        process.start()
+        measures = queue.get()
+        process.join()
+        logging.info('  %.0f rows/s, %i dropped, %i kB' % (measures['rows_per_second'], measures['dropped'], measures['peak_memory_kb']))
+        results.append(dict(configuration=configuration, measures=measures))
+    return results
+
+
+def compare(old, new, threshold=0.1):
+    '''returns the (configuration, metric, old value, new value) worsened by more than threshold'''
+    old = dict((key(result['configuration']), result['measures']) for result in old)
+    regressions = []
+    for result in new:
+        before = old.get(key(result['configuration']))
+        if before is None:
+            continue
+        for metric, direction in sorted(METRICS.items()):
+            a, b = before[metric], result['measures'][metric]
+            if direction * (a - b) > threshold * max(abs(a), 1):
+                regressions.append((result['configuration'], metric, a, b))
+    return regressions
+
+
+def main():
+    from argparse import ArgumentParser
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = ArgumentParser(description='Benchmark the association of generated tables.')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('spec', nargs='?', help='JSON file with the parameters to sweep')
+    run_parser.add_argument('-o', '--output', default='benchmark.json', help='JSON results file (default: benchmark.json)')
+    compare_parser = commands.add_parser('compare', help='flag the regressions between two results files')
+    compare_parser.add_argument('old', help='JSON results file of the baseline')
+    compare_parser.add_argument('new', help='JSON results file to check')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='relative tolerance (default: 0.1)')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        spec = dict(DEFAULT_SPEC)
+        if args.spec:
+            with open(args.spec) as spec_file:
+                spec.update(json.load(spec_file))
+        with open(args.output, 'w') as output:
+            json.dump(run(spec), output, indent=2)
+    else:
+        with open(args.old) as old, open(args.new) as new:
+            regressions = compare(json.load(old), json.load(new), args.threshold)
+        for configuration, metric, a, b in regressions:
+            print '{}: {} {} -> {}'.format(key(configuration), metric, a, b)
+        print '{} regressions'.format(len(regressions))
+        sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,15 @@
+from collections import defaultdict, Counter
+from tables import EncodedTable
 from utils import memo
 
 
+def relevant_constraints(constraints, fragments):
+    '''returns the constraints on attributes which are all in some fragment, the only
+    ones Constraints keeps, so that the other attributes need not be loaded'''
+    attributes = set(attribute for fragment in fragments for attribute in fragment)
+    return [constraint for constraint in constraints if set(constraint) <= attributes]
+
+
 class Constraints:
 
     def __init__(self, constraints, fragments):
@@ -24,6 +33,24 @@ class Constraints:
         return [c_id for c_id in xrange(len(self._constraints))
                 if fragment_id in self.involved_fragments_for(c_id)]
 
+    @memo
+    def attributes_for(self, fragment_id, constraint_id):
+        return sorted(self._constraints[constraint_id] & self._fragments[fragment_id])
+
+    def project(self, row, fragment_id, constraint_id):
+        '''returns the values of row that constraint_id insists on in fragment_id'''
+        return tuple(row[attribute] for attribute in self.attributes_for(fragment_id, constraint_id))
+
+    def histograms(self, table):
+        '''returns the frequency of every projected value, per (fragment, constraint)'''
+        histograms = defaultdict(Counter)
+        keys = [(fragment_id, constraint_id) for fragment_id in xrange(len(self._fragments))
+                for constraint_id in self.constraints_for(fragment_id)]
+        for row in table:
+            for fragment_id, constraint_id in keys:
+                histograms[fragment_id, constraint_id][self.project(row, fragment_id, constraint_id)] += 1
+        return histograms
+
     def are_rows_alike_for(self, row1, row2, fragment_id, constraint_id):
         for attribute in (self._constraints[constraint_id] & self._fragments[fragment_id]):
             if row1[attribute] != row2[attribute]:
@@ -35,3 +62,70 @@ class Constraints:
             if self.are_rows_alike_for(row1, row2, fragment_id, constraint_id):
                 return True
         return False
+
+
+class ConstraintIndex:
+    '''Groups holding every projected constraint value, per (fragment, constraint).
+
+    It is meant to be registered as a listener of an Associations object, so that
+    checking whether a row collides with some row of a group is a few dict lookups.
+    The values held by every group are kept as well, so that two groups are compared
+    by looking up the values of the smaller one. The values of an EncodedTable are
+    packed in single integers.'''
+
+    def __init__(self, table, constraints):
+        self._table = table
+        self._constraints = constraints
+        self._project = constraints.project
+        if isinstance(table, EncodedTable):
+            self._project = lambda row, fragment_id, constraint_id: table.pack(
+                row, constraints.attributes_for(fragment_id, constraint_id))
+        self._groups = defaultdict(Counter)
+        self._values = defaultdict(Counter)
+
+    def _keys(self, row, fragment_id):
+        return ((fragment_id, constraint_id, self._project(row, fragment_id, constraint_id))
+                for constraint_id in self._constraints.constraints_for(fragment_id))
+
+    def added(self, row_id, association):
+        row = self._table[row_id]
+        for fragment_id, group_id in enumerate(association):
+            for key in self._keys(row, fragment_id):
+                self._groups[key][group_id] += 1
+                self._values[key[:2] + (group_id,)][key[2]] += 1
+
+    def removed(self, row_id, association):
+        row = self._table[row_id]
+        for fragment_id, group_id in enumerate(association):
+            for key in self._keys(row, fragment_id):
+                _decrement(self._groups, key, group_id)
+                _decrement(self._values, key[:2] + (group_id,), key[2])
+
+    def _holds(self, key, group_id):
+        groups = self._groups.get(key)
+        return groups is not None and group_id in groups
+
+    def collides(self, row, fragment_id, group_id):
+        '''returns True if row is alike some row of group_id in fragment_id'''
+        return any(self._holds(key, group_id) for key in self._keys(row, fragment_id))
+
+    def are_groups_alike(self, fragment_id, constraint_id, group1, group2, row=None):
+        '''returns True if two distinct groups (the first one extended with row, if any)
+        share a value of constraint_id in fragment_id'''
+        values1 = self._values.get((fragment_id, constraint_id, group1), ())
+        values2 = self._values.get((fragment_id, constraint_id, group2), ())
+        values, other = (values1, group2) if len(values1) <= len(values2) else (values2, group1)
+        if any(self._holds((fragment_id, constraint_id, value), other) for value in values):
+            return True
+        return row is not None and self._holds(
+            (fragment_id, constraint_id, self._project(row, fragment_id, constraint_id)), group2)
+
+
+def _decrement(counters, key, item):
+    '''decrement counters[key][item], deleting the entries reaching zero'''
+    counter = counters[key]
+    counter[item] -= 1
+    if not counter[item]:
+        del counter[item]
+        if not counter:
+            del counters[key]
@@ -1,44 +1,215 @@
 from itertools import ifilter
 from operator import itemgetter
-from utils import shuffled, placeholders
+from utils import shuffled, placeholders, batches, forked_pool, forked_state
 import sqlite3
 import logging
+import os
+
+
+# settings for a one-shot load: the database is not usable if the export fails anyway
+BULK_PRAGMAS = ('journal_mode = OFF', 'synchronous = OFF', 'locking_mode = EXCLUSIVE',
+                'temp_store = MEMORY', 'cache_size = 100000')
 
 
 class Exporter:
 
+    BATCH = 10000
+
     def __init__(self, table, fragments, associations):
         self._table = table
         self._fragments = map(table.to_indices, fragments)
         self._associations = associations
 
-    def to_sqlite(self, database):
-        '''Export data to sqlite3 database'''
-        return self._to_db(sqlite3.connect(database) if isinstance(database, str) else database)
+    def to_sqlite(self, database, bulk=False, processes=None, summaries=False):
+        '''Export data to sqlite3 database. With bulk the database is set up for a one-shot
+        load, and with processes the fragments are written in parallel (bulk implied).
+        With summaries, the tables of the counts of every value in every group are added.'''
+        if processes:
+            if not isinstance(database, basestring):
+                raise ValueError('parallel export needs the filename of the database')
+            database = self._to_sqlite_in_parallel(database, processes)
+        else:
+            if isinstance(database, basestring):
+                database = _bulk_connect(database) if bulk else sqlite3.connect(database)
+            database = self._to_db(database, bulk)
+        if summaries:
+            self._create_summaries(database.cursor())
+            database.commit()
+        return database
+
+    def update_sqlite(self, database, previous):
+        '''Update a sqlite3 database exported with the previous associations'''
+        return self._update_db(sqlite3.connect(database) if isinstance(database, basestring) else database, previous)
 
-    def _to_db(self, database):
-        '''Common method to export data for all the relational databases using DB-API'''
+    def _update_db(self, database, previous):
+        '''Rewrite only the associations and the groups changed since previous (a mapping
+        from row ids to the associations that were exported)'''
+        cursor = database.cursor()
+        summarized = cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='group_sizes_0'").fetchall()
+        columns = len(self._fragments)
+        where = ' AND '.join('group_%i = ?' % i for i in xrange(columns))
+
+        removed = [tuple(association) for row, association in previous.iteritems()
+                   if association and self._associations.get(row, ()) != tuple(association)]
+        added = [association for row, association in self._associations.iteritems()
+                 if association and tuple(previous.get(row, ())) != association]
+        logging.info('updating %i associations ...' % (len(removed) + len(added)))
+        cursor.executemany('DELETE FROM associations WHERE %s' % where, removed)
+        cursor.executemany('INSERT INTO associations VALUES (%s)' % placeholders(columns), added)
+
+        for fragment_id, fragment in enumerate(self._fragments):
+            select = itemgetter(*fragment)
+            groups = set(association[fragment_id] for association in removed + added)
+            data = (select(self._table[row]) + (group,) for group in groups
+                    for row in shuffled(self._associations.get_group(fragment_id, group)))
+
+            logging.info('updating %i groups of the fragment_%i table ...' % (len(groups), fragment_id))
+            cursor.executemany('DELETE FROM fragment_{0} WHERE group_{0} = ?'.format(fragment_id), ((group,) for group in groups))
+            cursor.executemany('INSERT INTO fragment_%i VALUES (%s)' % (fragment_id, placeholders(len(fragment) + 1)), data)
+            if summarized:
+                for batch in batches(groups, 500):
+                    self._fill_summaries(cursor, fragment_id, batch)
+
+        # the joined tables materialized by the Querier are stale
+        if cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='joined_tables'").fetchall():
+            for joined, in cursor.execute('SELECT name FROM joined_tables').fetchall():
+                cursor.execute('DROP TABLE IF EXISTS %s' % joined)
+            cursor.execute('DELETE FROM joined_tables')
+
+        database.commit()
+        return database
+
+    def _to_db(self, database, bulk=False, fragments=True):
+        '''Common method to export data for all the relational databases using DB-API.
+        In bulk mode the indexes are created after the data is inserted.'''
         cursor = database.cursor()
 
         logging.info('creating the associations table ...')
         cursor.execute('CREATE TABLE associations (%s)' % ', '.join('group_%i INTEGER' % i for i in xrange(len(self._fragments))))
-        cursor.execute('CREATE UNIQUE INDEX i_associations ON associations (%s)' % ', '.join('group_%i' % i for i in xrange(len(self._fragments))))
-        cursor.executemany('INSERT INTO associations VALUES (%s)' % placeholders(len(self._fragments)), ifilter(None, (self._associations.values())))
+        if not bulk:
+            self._create_associations_index(cursor)
+        insert = 'INSERT INTO associations VALUES (%s)' % placeholders(len(self._fragments))
+        for batch in batches(ifilter(None, self._associations.itervalues()), self.BATCH):
+            cursor.executemany(insert, batch)
+        if bulk:
+            self._create_associations_index(cursor)
 
         # create the schema table that will be used by the querier to know where the attributes are
         cursor.execute('CREATE TABLE schema (attribute TEXT PRIMARY KEY, typ TEXT, fragment INTEGER)')
 
         for fragment_id, fragment in enumerate(self._fragments):
-            # select will extract only the data included in the fragment
-            select = itemgetter(*fragment)
-            attributes = select(self._table.attributes)
-            data = (select(self._table[row]) + (group,) for group, rows in self._associations.get_groups(fragment_id).items() for row in shuffled(rows))
-
-            logging.info('creating the fragment_%i table ...' % fragment_id)
-            cursor.execute('CREATE TABLE fragment_{0} ({1}, group_{0} INTEGER)'.format(fragment_id, ', '.join('%s %s' % attr for attr in attributes)))
-            cursor.execute('CREATE INDEX i_fragment_{0} ON fragment_{0} (group_{0})'.format(fragment_id))
-            cursor.executemany('INSERT INTO fragment_%i VALUES (%s)' % (fragment_id, placeholders(len(fragment) + 1)), data)
+            if fragments:
+                self._create_fragment(cursor, fragment_id, bulk)
+            attributes = itemgetter(*fragment)(self._table.attributes)
             cursor.executemany('INSERT INTO schema VALUES (?, ?, ?)', ((attr[0], attr[1], fragment_id) for attr in attributes))
 
         database.commit()
         return database
+
+    def _create_associations_index(self, cursor):
+        cursor.execute('CREATE UNIQUE INDEX i_associations ON associations (%s)' % ', '.join('group_%i' % i for i in xrange(len(self._fragments))))
+
+    def _create_fragment_table(self, cursor, fragment_id):
+        attributes = itemgetter(*self._fragments[fragment_id])(self._table.attributes)
+        cursor.execute('CREATE TABLE fragment_{0} ({1}, group_{0} INTEGER)'.format(fragment_id, ', '.join('%s %s' % attr for attr in attributes)))
+
+    def _create_fragment_index(self, cursor, fragment_id):
+        cursor.execute('CREATE INDEX i_fragment_{0} ON fragment_{0} (group_{0})'.format(fragment_id))
+
+    def _create_fragment(self, cursor, fragment_id, bulk=False):
+        fragment = self._fragments[fragment_id]
+        # select will extract only the data included in the fragment
+        select = itemgetter(*fragment)
+        data = (select(self._table[row]) + (group,) for group, rows in self._associations.iter_groups(fragment_id) for row in shuffled(rows))
+
+        logging.info('creating the fragment_%i table ...' % fragment_id)
+        self._create_fragment_table(cursor, fragment_id)
+        if not bulk:
+            self._create_fragment_index(cursor, fragment_id)
+        insert = 'INSERT INTO fragment_%i VALUES (%s)' % (fragment_id, placeholders(len(fragment) + 1))
+        for batch in batches(data, self.BATCH):
+            cursor.executemany(insert, batch)
+        if bulk:
+            self._create_fragment_index(cursor, fragment_id)
+
+    def _create_summaries(self, cursor):
+        '''Create the summary_<attribute> (value, group_id, count) tables, with the number of
+        rows of every group holding every value, and the group_sizes_<fragment> tables'''
+        for fragment_id, fragment in enumerate(self._fragments):
+            logging.info('creating the summaries of the fragment_%i table ...' % fragment_id)
+            for attribute, typ in (self._table.attributes[i] for i in fragment):
+                cursor.execute('CREATE TABLE summary_%s (value %s, group_id INTEGER, count INTEGER)' % (attribute, typ))
+                cursor.execute('CREATE INDEX i_summary_{0} ON summary_{0} (group_id)'.format(attribute))
+            cursor.execute('CREATE TABLE group_sizes_%i (group_id INTEGER PRIMARY KEY, size INTEGER)' % fragment_id)
+            self._fill_summaries(cursor, fragment_id)
+
+    def _fill_summaries(self, cursor, fragment_id, groups=None):
+        '''compute the summaries of groups (all of them by default) from the fragment table'''
+        attributes = [self._table.attributes[i][0] for i in self._fragments[fragment_id]]
+        tables = ['summary_%s' % attribute for attribute in attributes] + ['group_sizes_%i' % fragment_id]
+        where, parameters = '', ()
+        if groups is not None:
+            parameters = tuple(groups)
+            where = ' WHERE group_%i IN (%s)' % (fragment_id, placeholders(len(parameters)))
+            for table in tables:
+                cursor.execute('DELETE FROM %s WHERE group_id IN (%s)' % (table, placeholders(len(parameters))), parameters)
+        for attribute in attributes:
+            cursor.execute('INSERT INTO summary_{0} SELECT {0}, group_{1}, COUNT(*) FROM fragment_{1}{2} GROUP BY {0}, group_{1}'
+                           .format(attribute, fragment_id, where), parameters)
+        cursor.execute('INSERT INTO group_sizes_{0} SELECT group_{0}, COUNT(*) FROM fragment_{0}{1} GROUP BY group_{0}'
+                       .format(fragment_id, where), parameters)
+
+    def _to_sqlite_in_parallel(self, database, processes):
+        '''Write every fragment in its own database file in a pool of processes, then
+        attach the files to the main database and copy the fragments into it. The files
+        are removed afterwards, even if the export fails, and beforehand if stale.'''
+        files = ['%s.fragment_%i' % (database, fragment_id) for fragment_id in xrange(len(self._fragments))]
+        try:
+            for filename in files:
+                _remove(filename)
+            pool = forked_pool(processes, (self, files))
+            try:
+                pool.map(_export_fragment, xrange(len(self._fragments)))
+            finally:
+                pool.close()
+                pool.join()
+
+            database = _bulk_connect(database)
+            self._to_db(database, bulk=True, fragments=False)
+            cursor = database.cursor()
+            for fragment_id, filename in enumerate(files):
+                logging.info('copying the fragment_%i table ...' % fragment_id)
+                cursor.execute('ATTACH DATABASE ? AS part', (filename,))
+                self._create_fragment_table(cursor, fragment_id)
+                cursor.execute('INSERT INTO fragment_{0} SELECT * FROM part.fragment_{0}'.format(fragment_id))
+                database.commit()
+                cursor.execute('DETACH DATABASE part')
+                self._create_fragment_index(cursor, fragment_id)
+                _remove(filename)
+        finally:
+            for filename in files:
+                _remove(filename)
+
+        database.commit()
+        return database
+
+
+def _bulk_connect(filename):
+    '''connect to a sqlite3 database set up for a one-shot load'''
+    database = sqlite3.connect(filename)
+    for pragma in BULK_PRAGMAS:
+        database.execute('PRAGMA %s' % pragma)
+    return database
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _export_fragment(fragment_id):
+    exporter, files = forked_state()
+    database = _bulk_connect(files[fragment_id])
+    exporter._create_fragment(database.cursor(), fragment_id, bulk=True)
+    database.commit()
+    database.close()
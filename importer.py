@@ -0,0 +1,50 @@
+from collections import defaultdict
+from operator import itemgetter
+from tables import ListTable
+import sqlite3
+import logging
+
+
+class Importer:
+    '''Load a database written by the Exporter.
+
+    The association between the rows of the fragments is not published, so every
+    association is paired with one row of each of its groups: the resulting rows
+    are not the original ones, but they have exactly the same groups and
+    associations, which is all the heterogeneity checks depend on.'''
+
+    def __init__(self, database):
+        database = sqlite3.connect(database) if isinstance(database, basestring) else database
+        database.text_factory = str
+        cursor = database.cursor()
+
+        fragments = sorted(set(fragment for fragment, in cursor.execute('SELECT fragment FROM schema')))
+        schema = dict((attribute, typ) for attribute, typ in cursor.execute('SELECT attribute, typ FROM schema'))
+
+        self.fragments = []
+        groups = []
+        for fragment_id in fragments:
+            logging.info('loading the fragment_%i table ...' % fragment_id)
+            columns = map(itemgetter(1), cursor.execute('pragma table_info(fragment_%i)' % fragment_id).fetchall())
+            self.fragments.append(columns[:-1])
+            group_rows = defaultdict(list)
+            for row in cursor.execute('SELECT * FROM fragment_%i' % fragment_id):
+                group_rows[row[-1]].append(row[:-1])
+            groups.append(group_rows)
+
+        self.attributes = [(attribute, schema[attribute]) for fragment in self.fragments for attribute in fragment]
+
+        logging.info('loading the associations table ...')
+        rows, self.associations = [], {}
+        for association in cursor.execute('SELECT * FROM associations'):
+            self.associations[len(rows)] = association
+            rows.append(sum((groups[fragment_id][group_id].pop() for fragment_id, group_id in enumerate(association)), ()))
+        self._rows = rows
+
+        self.table = ListTable(self.attributes, self._rows)
+
+    def extended_with(self, table):
+        '''returns the loaded table followed by the rows of table, restricted to the published attributes'''
+        select = itemgetter(*table.to_indices(map(itemgetter(0), self.attributes)))
+        rows = [tuple(select(row)) if len(self.attributes) > 1 else (select(row),) for row in table]
+        return ListTable(self.attributes, self._rows + rows)
@@ -1,11 +1,32 @@
-from associations import Associations
-from constraints import Constraints
-from collections import defaultdict, Counter, deque
-from itertools import count, chain
+from associations import Associations, CompactAssociations
+from constraints import Constraints, ConstraintIndex, relevant_constraints
+from collections import defaultdict, Counter
+from itertools import count, islice, chain
 from operator import itemgetter
-from random import random
-from utils import neighbours, make_withtime
+from multiprocessing import cpu_count
+from random import Random
+from contextlib import contextmanager
+from stats import Stats
+from time import time
+from tables import SlicedTable
+from utils import neighbours, make_withtime, forked_pool, forked_state
+from worklist import Worklist
 import logging
+import cProfile
+import marshal
+
+
+GROUP_ORDERS = ('first', 'fullest', 'emptiest')
+
+ROW_ORDERS = ('table', 'frequent')
+
+OPERATIONS = ('redistribute', 'delete')
+
+# the checks measured by Stats, with their names
+CHECKS = {'_check_group_heterogenity': 'group',
+          '_check_association_heterogenity': 'association',
+          '_check_deep_heterogenity_of_association': 'deep_association',
+          '_check_deep_heterogenity_of_associated_groups': 'deep_associated_groups'}
 
 
 class Loose:
@@ -13,34 +34,45 @@ class Loose:
     def __init__(self, table, constraints, fragments):
         self._table, self.tuples = table, len(table)
         self._fragments = map(table.to_indices, fragments)
-        self._constraints = Constraints(map(table.to_indices, constraints), self._fragments)
+        if isinstance(constraints, Constraints):
+            self._constraints = constraints
+        else:
+            self._constraints = Constraints(map(table.to_indices, constraints), self._fragments)
 
     def _get_group_data(self, fragment_id, group_id):
         return ((row_id, self._table[row_id]) for row_id in self._associations.get_group(fragment_id, group_id))
 
-    def _get_nonfull_groups(self, fragment_id, allow_skips=True, **kwargs):
-        groups_to_check = xrange(self._first_nonfull[fragment_id], self._last_usable[fragment_id] + 1)
-        return (group_id for group_id in groups_to_check
-                if not self._associations.is_group_full(fragment_id, group_id))
-                # uncomment this to allow skips
-                # if not allow_skips or not self._skip_probability or random() > self._skip_probability)
+    def _get_nonfull_groups(self, fragment_id, allow_skips=True, order=None, **kwargs):
+        start, stop = self._first_nonfull[fragment_id], self._last_usable[fragment_id] + 1
+        order = order or self._group_order
+        if order in ('fullest', 'emptiest'):
+            # the store keeps the non-full groups bucketed by size
+            return self._associations.iter_nonfull_groups_by_size(fragment_id, start, stop, order == 'fullest')
+        groups_to_check = self._associations.iter_nonfull_groups(fragment_id, start, stop)
+        if callable(order):
+            # the search resumes the candidates after a backtrack, so they must be an iterator
+            return iter(order(self, fragment_id, groups_to_check))
+        return groups_to_check
 
     def _are_groups_alike(self, current_group, other_group, fragment_id, constraint_id, current_row):
-        current_rows = self._get_group_data(fragment_id, current_group)
-        if current_row:
-            current_rows = chain([(0, current_row)], current_rows)
-
-        for _, row1 in current_rows:
-            for _, row2 in self._get_group_data(fragment_id, other_group):
-                if self._constraints.are_rows_alike_for(row1, row2, fragment_id, constraint_id):
-                    return True
-        return False
+        # every row is alike itself, so a group is alike itself unless it is empty
+        if current_group == other_group:
+            return self._associations.get_group_size(fragment_id, other_group) > 0
+        if self._index is None:
+            other_rows = [row for _, row in self._get_group_data(fragment_id, other_group)]
+            current_rows = chain([current_row] if current_row else [],
+                                 (row for _, row in self._get_group_data(fragment_id, current_group)))
+            return any(self._constraints.are_rows_alike_for(row1, row2, fragment_id, constraint_id)
+                       for row1 in current_rows for row2 in other_rows)
+        return self._index.are_groups_alike(fragment_id, constraint_id, current_group, other_group, current_row)
 
     def _check_group_heterogenity(self, row, fragment_id, group_id):
-        for _, other_row in self._get_group_data(fragment_id, group_id):
-            if self._constraints.are_rows_alike(row, other_row, fragment_id):
-                # logging.trace('GROUP VIOLATED fragment {} group {}'.format(fragment_id, group_id))
-                return False
+        if self._index is None:
+            return not any(self._constraints.are_rows_alike(row, other_row, fragment_id)
+                           for _, other_row in self._get_group_data(fragment_id, group_id))
+        if self._index.collides(row, fragment_id, group_id):
+            # logging.trace('GROUP VIOLATED fragment {} group {}'.format(fragment_id, group_id))
+            return False
         return True
 
     def _check_association_heterogenity(self, association, fragment_id, group_id):
@@ -110,52 +142,92 @@ class Loose:
                 self._check_association_heterogenity(association, fragment_id, group_id) and
                 self._check_deep_heterogenity(row, association, fragment_id, group_id))
 
-    def _extend_association(self, row, row_id, association=[]):
-        fragment_id = len(association)
-        if (fragment_id == len(self._fragments)):
-            return association
-
-        for group_id in self._get_nonfull_groups(fragment_id, row_id=row_id):
-            if self._check_heterogenity(row, association, fragment_id, group_id):
-                result = self._extend_association(row, row_id, association + [group_id])
-                if result is not None:
-                    return result
+    def _extend_association(self, row, row_id, association=()):
+        '''Depth first search of the groups completing association for row. Returns None if
+        there are none, and False if the search backtracked more than budget times (if any).'''
+        association = list(association)
+        budget, stats = self._budget, self.stats
+        candidates = [self._get_nonfull_groups(len(association), row_id=row_id)]
+        tried = backtracks = 0
+        while candidates and len(association) < len(self._fragments):
+            fragment_id = len(association)
+            for group_id in candidates[-1]:
+                tried += 1
+                if stats:
+                    stats.extensions[fragment_id] += 1
+                if self._check_heterogenity(row, association, fragment_id, group_id):
+                    association.append(group_id)
+                    if fragment_id + 1 < len(self._fragments):
+                        candidates.append(self._get_nonfull_groups(fragment_id + 1, row_id=row_id))
+                    break
+            else:
+                # no group left at this depth: backtrack
+                candidates.pop()
+                if candidates:
+                    association.pop()
+                    backtracks += 1
+                    if stats:
+                        stats.backtracks[fragment_id] += 1
+                    if budget is not None and backtracks > budget:
+                        if stats:
+                            stats.count('budget_exhausted')
+                        return False
+        if stats:
+            stats.max_extensions_per_row = max(stats.max_extensions_per_row, tried)
+        return association if candidates else None
 
     def _full_neighbours_groups(self, fragment_id, group_id, step=1):
-        return (new_group_id for new_group_id in neighbours(group_id, 0, self._last_usable[fragment_id] + 1)
-                if self._associations.is_group_full(fragment_id, new_group_id))
+        groups = (new_group_id for new_group_id in neighbours(group_id, 0, self._last_usable[fragment_id] + 1)
+                  if self._associations.is_group_full(fragment_id, new_group_id))
+        # among the nearest full groups try first the least crowded ones, then the others by distance
+        nearest = sorted(islice(groups, self._target_window),
+                         key=lambda new_group_id: self._associations.get_group_size(fragment_id, new_group_id))
+        return chain(nearest, groups)
         
     def _redistribute_group(self, fragment_id, group_id, step=1):
-        logging.debug('redistributing group {} in fragment {}'.format(group_id, fragment_id))
+        logging.debug('redistributing group %s in fragment %s', group_id, fragment_id)
         for row_id, row in self._get_group_data(fragment_id, group_id):
             association = self._associations[row_id]
             if association:
                 for new_group_id in self._full_neighbours_groups(fragment_id, group_id, step):
                     if self._check_heterogenity(row, association, fragment_id, new_group_id):
-                        logging.debug('fragment {} row {}: group {} -> group {}'.format(fragment_id, row_id, group_id, new_group_id))
+                        logging.debug('fragment %s row %s: group %s -> group %s', fragment_id, row_id, group_id, new_group_id)
                         new_association = list(association)
                         new_association[fragment_id] = new_group_id
                         self._associations[row_id] = new_association
                         break
                 else:
-                    logging.debug('fragment {} row {} : group {} -> not reallocable'.format(fragment_id, row_id, group_id))
-                    self._opstack.append((1, (row_id, step)))    # delete
+                    logging.debug('fragment %s row %s : group %s -> not reallocable', fragment_id, row_id, group_id)
+                    self._push((1, (row_id, step)))    # delete
 
     def _delete_row(self, row_id, step=1):
         self._dropped.add(row_id)
         association = self._associations[row_id]
-        logging.debug('deleting row {} = {}'.format(row_id, association))
+        logging.debug('deleting row %s = %s', row_id, association)
         del self._associations[row_id]
         for fragment_id, group_id in enumerate(association):
             if not self._associations.is_group_full(fragment_id, group_id):
-                self._opstack.append((0, (fragment_id, group_id, step + 1)))    # redistribute
-        logging.info('row {} deleted (step {})'.format(row_id, step))
+                self._push((0, (fragment_id, group_id, step + 1)))    # redistribute
+        logging.info('row %s deleted (step %s)', row_id, step)
+
+    def _priority(self, operation):
+        '''deletes come first, then the redistribution of the groups closest to be full'''
+        if operation[0]:
+            return (0,)
+        fragment_id, group_id = operation[1][:2]
+        return (1, self._k_list[fragment_id] - self._associations.get_group_size(fragment_id, group_id))
+
+    def _push(self, operation):
+        # operations on the same row or group are coalesced
+        key = (operation[0],) + operation[1][:1 if operation[0] else 2]
+        pushed = self._worklist.push(key, self._priority(operation), operation)
+        if self.stats:
+            self.stats.count(('push.' if pushed else 'coalesced.') + OPERATIONS[operation[0]])
 
     def _update_first_nonfull(self, association):
         for fragment_id, group_id in enumerate(association):
             if group_id == self._first_nonfull[fragment_id]:
-                while (self._associations.is_group_full(fragment_id, self._first_nonfull[fragment_id])):
-                    self._first_nonfull[fragment_id] += 1
+                self._first_nonfull[fragment_id] = self._associations.next_nonfull_group(fragment_id, group_id)
 
     def _update_last_usable(self, association):
         for fragment_id, group_id in enumerate(association):
@@ -166,48 +238,315 @@ class Loose:
         self._update_first_nonfull(association)
         self._update_last_usable(association)
 
-    def associate(self, k_list, skip_probability=0, **kwargs):
+    def _setup(self, k_list, skip_probability=0, **kwargs):
         assert(len(k_list) == len(self._fragments))
-        print_stats_every = kwargs.get('print_stats_every', 1000)
+        self._print_stats_every = kwargs.get('print_stats_every', 1000)
+        self._group_order = kwargs.get('group_order', 'first')
+        if not callable(self._group_order) and self._group_order not in GROUP_ORDERS:
+            raise ValueError('unknown group order %s. Expected one of %s' % (self._group_order, GROUP_ORDERS))
+        self._row_order = kwargs.get('row_order', 'table')
+        if self._row_order not in ROW_ORDERS:
+            raise ValueError('unknown row order %s. Expected one of %s' % (self._row_order, ROW_ORDERS))
+        self._budget = kwargs.get('budget')
 
         self._k_list = k_list
         self._first_nonfull = [0 for _ in xrange(len(self._fragments))]
         self._last_usable = [0 for _ in xrange(len(self._fragments))]
-        self._associations = Associations(self._k_list)
+        if kwargs.get('compact', False):
+            # the groups are scanned instead of indexed, which would take most of the memory
+            self._index = None
+            self._associations = CompactAssociations(self._k_list, self.tuples)
+        else:
+            self._index = ConstraintIndex(self._table, self._constraints)
+            self._associations = Associations(self._k_list, [self._index])
         self._dropped = set()
         self._skip_probability = skip_probability
+        self._withtime = make_withtime()
+        self._target_window = kwargs.get('target_window', 8)
+        self.stats = Stats() if kwargs.get('stats') else None
+        self._instrument()
+
+    def _instrument(self):
+        '''wrap the measured methods when collecting stats, unwrap them otherwise'''
+        for method in CHECKS:
+            self.__dict__.pop(method, None)
+        if self.stats:
+            for method, name in CHECKS.items():
+                setattr(self, method, self.stats.check(name, getattr(self, method)))
+
+    @contextmanager
+    def _phase(self, name):
+        started = time()
+        yield
+        if self.stats:
+            self.stats.phases[name] = time() - started
+
+    @contextmanager
+    def _profiling(self, path):
+        '''profile the block with cProfile, writing the results in path (if any)'''
+        if not path:
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+
+    def _dump_stats(self, path):
+        if self.stats and isinstance(path, basestring):
+            self.stats.dump(path)
+
+    def _rows(self, seed=None):
+        '''returns the rows with their ids, in the order given by seed if any. With the
+        'frequent' row order, the rows with the most common constraint values come first
+        (the order given by seed breaks the ties)'''
+        if seed is None and self._row_order == 'table':
+            return enumerate(self._table)
+        order = range(self.tuples)
+        if seed is not None:
+            Random(seed).shuffle(order)
+        if self._row_order == 'frequent':
+            order.sort(key=self._contention(), reverse=True)
+        return ((row_id, self._table[row_id]) for row_id in order)
+
+    def _contention(self):
+        '''returns a function giving the frequency of the most common constraint value of a row'''
+        histograms = self._constraints.histograms(self._table)
+        keys = [(fragment_id, constraint_id) for fragment_id in xrange(len(self._fragments))
+                for constraint_id in self._constraints.constraints_for(fragment_id)]
+        def contention(row_id):
+            row = self._table[row_id]
+            return max([histograms[f, c][self._constraints.project(row, f, c)] for f, c in keys] or [0])
+        return contention
+
+    def _presolve(self):
+        '''returns the rows which cannot be associated, and a lower bound of the number of groups
+        of every fragment. The rows of a group hold different values of every constraint, so
+        the rows sharing a value are spread on as many groups, while a fragment can have at
+        most (rows / k) groups: the rows exceeding it are dropped, until the bound is stable.'''
+        keys = [(fragment_id, constraint_id) for fragment_id in xrange(len(self._fragments))
+                for constraint_id in self._constraints.constraints_for(fragment_id)]
+        histograms = self._constraints.histograms(self._table)
+        infeasible = set()
+        while True:
+            groups = [(self.tuples - len(infeasible)) // k for k in self._k_list]
+            hot = set((fragment_id, constraint_id, value) for fragment_id, constraint_id in keys
+                      for value, frequency in histograms[fragment_id, constraint_id].iteritems()
+                      if frequency > groups[fragment_id])
+            if not hot:
+                break
+            rows = defaultdict(list)
+            for row_id, row in enumerate(self._table):
+                if row_id not in infeasible:
+                    for fragment_id, constraint_id in keys:
+                        key = (fragment_id, constraint_id, self._constraints.project(row, fragment_id, constraint_id))
+                        if key in hot:
+                            rows[key].append(row_id)
+            for (fragment_id, constraint_id, value), row_ids in rows.iteritems():
+                for row_id in [row_id for row_id in row_ids if row_id not in infeasible][groups[fragment_id]:]:
+                    infeasible.add(row_id)
+                    row = self._table[row_id]
+                    for f, c in keys:
+                        histograms[f, c][self._constraints.project(row, f, c)] -= 1
+        bounds = [max([max(histograms[fragment_id, constraint_id].values() or [0])
+                       for constraint_id in self._constraints.constraints_for(fragment_id)] or [0])
+                  for fragment_id in xrange(len(self._fragments))]
+        return infeasible, bounds
+
+    def _load(self, associations, check=False):
+        '''insert the (row id, association) pairs and set the group pointers. With check,
+        only the associations passing the heterogenity checks are inserted, and the ids
+        of the rows rejected are returned'''
+        rejected = []
+        for row_id, association in associations:
+            if association:
+                if check and not self._is_association_heterogeneous(row_id, association):
+                    rejected.append(row_id)
+                    continue
+                self._associations[row_id] = association
+                self._update_last_usable(association)
+        self._reset_first_nonfull()
+        return rejected
+
+    def _reset_first_nonfull(self):
+        self._first_nonfull = [self._associations.next_nonfull_group(fragment_id, 0)
+                               for fragment_id in xrange(len(self._fragments))]
+
+    def _undersized_rows(self):
+        '''returns the ids of the rows in some group smaller than its k'''
+        return set(row_id for fragment_id, k in enumerate(self._k_list)
+                   for group_id, rows in self._associations.iter_groups(fragment_id)
+                   if len(rows) < k for row_id in rows)
+
+    def _is_association_heterogeneous(self, row_id, association):
+        row = self._table[row_id]
+        for fragment_id, group_id in enumerate(association):
+            if not self._check_heterogenity(row, list(association[:fragment_id]), fragment_id, group_id):
+                return False
+        return True
 
-        withtime = make_withtime()
-        for row_id, row in enumerate(self._table):
-            if row_id and not row_id % print_stats_every:
-                logging.info(withtime('associating row: %i firsts: %s lasts: %s'
+    def _first_scan(self, rows):
+        deferred = []
+        for row_id, row in rows:
+            if row_id and not row_id % self._print_stats_every:
+                logging.info(self._withtime('associating row: %i firsts: %s lasts: %s'
                     % (row_id, self._first_nonfull, self._last_usable)))
 
             association = self._extend_association(row, row_id)
-            if association is None:
-                self._dropped.add(row_id)
-                logging.info('row_id {} dropped at first scan'.format(row_id))
+            if association is False:
+                # out of budget: try again once the other rows are placed
+                deferred.append((row_id, row))
             else:
-                self._associations[row_id] = association
-                self._update_pointers(association)
-
-        self._opstack = deque()
+                self._place(row_id, association)
+
+        if deferred:
+            logging.info(self._withtime('associating %i deferred rows' % len(deferred)))
+        for row_id, row in deferred:
+            self._place(row_id, self._extend_association(row, row_id) or None)
+
+    def _place(self, row_id, association):
+        if association is None:
+            self._dropped.add(row_id)
+            logging.info('row_id %s dropped at first scan', row_id)
+        else:
+            self._associations[row_id] = association
+            self._update_pointers(association)
+
+    def _repair(self):
+        self._worklist = Worklist()
         for fragment_id in xrange(len(self._fragments)):
-            for group_id in self._get_nonfull_groups(fragment_id, False):
+            for group_id in self._get_nonfull_groups(fragment_id, False, 'first'):
                 if self._associations.get_group_size(fragment_id, group_id):
-                    self._opstack.append((0, (fragment_id, group_id)))    # redistribute
+                    self._push((0, (fragment_id, group_id)))    # redistribute
 
         counter = count()
-        while self._opstack:
+        while self._worklist:
+            key, priority, operation = self._worklist.pop()
+            if not operation[0]:
+                fragment_id, group_id = operation[1][:2]
+                if (not self._associations.get_group_size(fragment_id, group_id) or
+                        self._associations.is_group_full(fragment_id, group_id)):
+                    if self.stats:
+                        self.stats.count('skipped.redistribute')
+                    continue
+                if self._priority(operation) != priority:
+                    # the group changed since it was pushed
+                    self._worklist.push(key, self._priority(operation), operation)
+                    continue
+
             if not next(counter) % 10:
-                logging.info(withtime('opstack length: %i' % len(self._opstack)))
-            operation = self._opstack.pop()
+                logging.info(self._withtime('worklist length: %i' % len(self._worklist)))
+            if self.stats:
+                self.stats.count('pop.' + OPERATIONS[operation[0]])
             fn = self._delete_row if operation[0] else self._redistribute_group
             fn(*operation[1])
 
-        logging.info(withtime('done after %i stack operations' % (next(counter))))
+        self.operations = next(counter)
+        logging.info(self._withtime('done after %i stack operations' % self.operations))
+        return self._associations, self._dropped
+
+    def associate(self, k_list, skip_probability=0, **kwargs):
+        '''Associate the rows of the table. group_order chooses the order in which
+        the non-full groups are tried: 'first' (lowest id), 'fullest' or 'emptiest' (of the
+        non-empty ones, the empty ones coming last), or a function of (loose, fragment_id,
+        groups) returning them in the order to try.
+        With a seed, the rows are visited in the random order it determines, and with
+        row_order 'frequent' the rows with the most common constraint values are placed first.
+        budget limits the backtracks of the search of a row: the rows running out of it are
+        tried again after the others, and dropped if they run out of it again.
+        With presolve, the rows which cannot be associated with k_list whatever the groups
+        are dropped upfront.
+        With stats, counters and timers are collected in the stats attribute (and
+        dumped as JSON if stats is a path), and profile is a path for cProfile results.'''
+        self._setup(k_list, skip_probability, **kwargs)
+        with self._profiling(kwargs.get('profile')):
+            rows = self._rows(kwargs.get('seed'))
+            if kwargs.get('presolve'):
+                with self._phase('presolve'):
+                    infeasible, self.group_bounds = self._presolve()
+                logging.info(self._withtime('%i rows cannot be associated, at least %s groups'
+                                            % (len(infeasible), self.group_bounds)))
+                self._dropped.update(infeasible)
+                rows = ((row_id, row) for row_id, row in rows if row_id not in infeasible)
+            with self._phase('first_scan'):
+                self._first_scan(rows)
+            with self._phase('repair'):
+                self._repair()
+        self._dump_stats(kwargs.get('stats'))
+        return self._associations, self._dropped
+
+    def resume(self, k_list, previous, **kwargs):
+        '''Associate the rows of the table which are not in previous (a mapping from row
+        ids to associations), keeping the associations in previous untouched, and repair
+        the non-full groups left by the new rows.'''
+        self._setup(k_list, **kwargs)
+        self._load(previous.iteritems())
+        self._first_scan((row_id, self._table[row_id]) for row_id in xrange(self.tuples) if row_id not in previous)
+        return self._repair()
+
+    def warm_start(self, k_list, previous, **kwargs):
+        '''Associate the rows of the table starting from previous (a mapping from row ids to
+        associations, found with other k or constraints): the associations which are still
+        heterogeneous are kept, the other rows are placed again, and the groups left
+        non-full by the rejected rows are repaired. The rows of the groups smaller than the
+        new k are placed again as well, since the repair only moves rows to full groups.
+        The heterogeneity does not depend on k: when only k changed, check=False skips
+        the checks of the previous associations, which is most of the cost.'''
+        self._setup(k_list, **kwargs)
+        with self._phase('load'):
+            rejected = self._load(previous.iteritems(), check=kwargs.get('check', True))
+            undersized = self._undersized_rows()
+            for row_id in undersized:
+                del self._associations[row_id]
+            self._reset_first_nonfull()
+        logging.info(self._withtime('%i associations rejected, %i in undersized groups' % (len(rejected), len(undersized))))
+        with self._phase('first_scan'):
+            self._first_scan((row_id, self._table[row_id]) for row_id in xrange(self.tuples)
+                             if not self._associations.get(row_id))
+        with self._phase('repair'):
+            self._repair()
+        self._dump_stats(kwargs.get('stats'))
         return self._associations, self._dropped
 
+    def associate_in_parallel(self, k_list, processes=None, partitions=None, **kwargs):
+        '''Run the first scan on contiguous partitions of the table in a pool of processes
+        (which share the table by forking), then merge the partial associations, giving
+        disjoint group ids to every partition, and repair the non-full groups left.
+        The stats of the partitions are summed in the stats of the whole run.'''
+        processes = processes or cpu_count()
+        partitions = partitions or processes
+        bounds = [self.tuples * i // partitions for i in xrange(partitions + 1)]
+
+        self._table = self._table.materialized()
+        self._setup(k_list, **kwargs)
+        with self._profiling(kwargs.get('profile')):
+            with self._phase('first_scan'):
+                pool = forked_pool(processes, (self._table, self._constraints, self._fragments, k_list, kwargs))
+                try:
+                    results = pool.map(_first_scan_partition, zip(bounds, bounds[1:]))
+                finally:
+                    pool.close()
+                    pool.join()
+
+            offsets, merged = [0 for _ in xrange(len(self._fragments))], []
+            for start, associations, dropped, last_usable, stats in results:
+                merged.extend((start + row_id, [offset + group_id for offset, group_id in zip(offsets, association)])
+                              for row_id, association in associations)
+                self._dropped.update(start + row_id for row_id in dropped)
+                offsets = [offset + groups for offset, groups in zip(offsets, last_usable)]
+                if self.stats:
+                    self.stats.update(stats)
+
+            self._load(merged)
+            logging.info(self._withtime('merged %i partitions' % partitions))
+            with self._phase('repair'):
+                result = self._repair()
+        self._dump_stats(kwargs.get('stats'))
+        return result
+
     def associate_with_retries(self, k_list, retries, skip_probability=0.05, **kwargs):
         for i in xrange(retries):
             associations, dropped = self.associate(k_list, skip_probability, **kwargs)
@@ -216,6 +555,45 @@ class Loose:
                 return associations, i
         logging.info('No solution found')
 
+    def associate_with_seeds(self, k_list, seeds, processes=None, group_orders=None, **kwargs):
+        '''Run in a pool of processes an attempt for every seed, visiting the rows in the order
+        given by the seed and cycling through group_orders, if any. The remaining attempts are
+        cancelled as soon as one drops no row. Returns the associations, the dropped rows and
+        the seed of that attempt, or of the attempt with the fewest dropped rows. The stats and
+        profile are the ones of that attempt, written by this process only.'''
+        group_orders = group_orders or [kwargs.get('group_order', 'first')]
+        attempts = [(seed, group_orders[i % len(group_orders)]) for i, seed in enumerate(seeds)]
+
+        best = None
+        self._table = self._table.materialized()
+        # the workers keep their stats and profile in memory, to be written for the best attempt only
+        pool = forked_pool(processes or cpu_count(),
+                           (self, k_list, dict(kwargs, stats=bool(kwargs.get('stats')), profile=None),
+                            bool(kwargs.get('profile'))))
+        try:
+            for seed, group_order, associations, dropped, stats, profile in pool.imap_unordered(_attempt, attempts):
+                logging.info('seed {} ({}): {} rows dropped'.format(seed, group_order, len(dropped)))
+                if best is None or len(dropped) < len(best[3]):
+                    best = seed, group_order, associations, dropped, stats, profile
+                if not dropped:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+
+        seed, group_order, associations, dropped, stats, profile = best
+        logging.info('using seed {} ({})'.format(seed, group_order))
+        self._setup(k_list, **dict(kwargs, group_order=group_order))
+        self._load(associations)
+        self._dropped.update(dropped)
+        if self.stats:
+            self.stats.update(stats)
+            self._dump_stats(kwargs.get('stats'))
+        if profile:
+            with open(kwargs['profile'], 'wb') as output:
+                marshal.dump(profile, output)
+        return self._associations, self._dropped, seed
+
     def print_statistics(self):
         for fragment_id in xrange(len(self._fragments)):
             print '\nFragment {}'.format(fragment_id)
@@ -226,6 +604,132 @@ class Loose:
         print '\n{} ({:.3%}) lines dropped: {}'.format(len(self._dropped), float(len(self._dropped)) / self.tuples, self._dropped)
 
 
+def _first_scan_partition((start, stop)):
+    table, constraints, fragments, k_list, kwargs = forked_state()
+    loose = Loose(SlicedTable(table, start, stop), constraints, fragments)
+    loose._setup(k_list, **kwargs)
+    loose._first_scan(enumerate(loose._table))
+    associations = [(row_id, association) for row_id, association in loose._associations.iteritems() if association]
+    return start, associations, sorted(loose._dropped), loose._last_usable, loose.stats
+
+
+def _attempt((seed, group_order)):
+    '''associate with seed and group_order, returning the results with the stats and the
+    cProfile stats (in the format of Profile.dump_stats) of the attempt'''
+    loose, k_list, kwargs, profile = forked_state()
+    profiler = cProfile.Profile() if profile else None
+    if profiler:
+        profiler.enable()
+    associations, dropped = loose.associate(k_list, **dict(kwargs, seed=seed, group_order=group_order))
+    if profiler:
+        profiler.disable()
+        profiler.create_stats()
+    return (seed, group_order, [(row_id, association) for row_id, association in associations.iteritems() if association],
+            sorted(dropped), loose.stats, profiler and profiler.stats)
+
+
+# the options running their own pools of processes, which cannot be nested in a batch
+BATCH_UNSUPPORTED = ('seeds', 'processes', 'export_processes')
+
+
+def _plan(config):
+    '''choose the k_list of config from the samples of its table, when it gives k instead'''
+    if 'k_list' not in config:
+        from planner import Planner
+        planner = Planner(config['database'], config['table'], config['constraints'], config['fragments'],
+                          config.get('plan_sizes', (250, 500, 1000)))
+        # the sample associations log every operation
+        logging.disable(logging.INFO)
+        config['k_list'] = planner.best(config['k'])
+        logging.disable(logging.NOTSET)
+        print 'k_list: {}'.format(config['k_list'])
+
+
+def _associate_and_export(config, table, constraints=None):
+    '''associate table as configured and export it, returning the Loose instance and the dropped rows.
+    With encode, table is better a streamed SqliteTable, which is encoded without a copy of its rows.'''
+    from exporter import Exporter
+    from tables import EncodedTable
+
+    if config.get('encode', False) and not isinstance(table, EncodedTable):
+        table = EncodedTable(table)
+    if isinstance(table, EncodedTable):
+        encoded, table = table, table.decoded
+    else:
+        encoded = table
+
+    loose = Loose(encoded, constraints or relevant_constraints(config['constraints'], config['fragments']), config['fragments'])
+    options = dict(compact=config.get('compact', False), group_order=config.get('group_order', 'first'),
+                   stats=config.get('stats'), profile=config.get('profile'),
+                   row_order=config.get('row_order', 'table'), budget=config.get('budget'),
+                   presolve=config.get('presolve', False))
+    if config.get('seeds'):
+        associations, dropped, seed = loose.associate_with_seeds(config['k_list'], config['seeds'],
+                                                                 config.get('processes'), config.get('group_orders'), **options)
+        print 'seed: {}'.format(seed)
+    elif config.get('processes'):
+        associations, dropped = loose.associate_in_parallel(config['k_list'], config['processes'],
+                                                            config.get('partitions'), **options)
+    else:
+        associations, dropped = loose.associate(config['k_list'], config.get('skip_probability', 0), **options)
+
+    Exporter(table, config['fragments'], associations).to_sqlite(config['output'], config.get('bulk', False),
+                                                                 config.get('export_processes'), config.get('summaries', False))
+    return loose, dropped
+
+
+def run_batch(configs, workers=None):
+    '''Run the configurations in a pool of workers processes, loading every source table
+    once (with the attributes of all its fragments) and building the Constraints once
+    for the configurations with the same fragments and constraints. A source is loaded
+    encoded when some of its configurations encode it, and is then shared encoded.'''
+    from tables import SqliteTable, EncodedTable
+    import json
+
+    attributes, encode = defaultdict(set), set()
+    for config in configs:
+        unsupported = [option for option in BATCH_UNSUPPORTED if config.get(option)]
+        if unsupported:
+            raise ValueError('%s cannot be used in a batch (%s)' % (', '.join(unsupported), config['output']))
+        _plan(config)
+        attributes[config['database'], config['table']].update(
+            attribute for fragment in config['fragments'] for attribute in fragment)
+        if config.get('encode', False):
+            encode.add((config['database'], config['table']))
+
+    tables = {}
+    for (database, tablename), source_attributes in attributes.iteritems():
+        logging.info('loading %s from %s ...' % (tablename, database))
+        if (database, tablename) in encode:
+            tables[database, tablename] = EncodedTable(SqliteTable(database, tablename, attributes=source_attributes, stream=True))
+        else:
+            tables[database, tablename] = SqliteTable(database, tablename, attributes=source_attributes)
+
+    compiled, constraints = {}, []
+    for config in configs:
+        table = tables[config['database'], config['table']]
+        key = json.dumps([config['database'], config['table'], config['fragments'], config['constraints']], sort_keys=True)
+        if key not in compiled:
+            compiled[key] = Constraints(map(table.to_indices, relevant_constraints(config['constraints'], config['fragments'])),
+                                        map(table.to_indices, config['fragments']))
+        constraints.append(compiled[key])
+
+    pool = forked_pool(workers, (configs, tables, constraints))
+    try:
+        for output, dropped in pool.imap(_batch_job, xrange(len(configs))):
+            print '{}: {} lines dropped'.format(output, dropped)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _batch_job(job_id):
+    configs, tables, constraints = forked_state()
+    config = configs[job_id]
+    loose, dropped = _associate_and_export(config, tables[config['database'], config['table']], constraints[job_id])
+    return config['output'], len(dropped)
+
+
 def main():
     from argparse import ArgumentParser
     from exporter import Exporter
@@ -235,18 +739,55 @@ def main():
     logging.basicConfig(level=logging.INFO, format='%(message)s')
 
     parser = ArgumentParser(description='Create the loose-associations database.')
-    parser.add_argument('config_file', help='JSON configuration file')
+    parser.add_argument('config_file', help='JSON configuration file (or list of configurations to run in a batch)')
+    parser.add_argument('--insert', metavar='TABLE', help='insert the rows of TABLE into the existing output database')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='associate the existing output database again with the k_list and constraints of the configuration')
+    parser.add_argument('--workers', type=int, help='processes running the configurations of a batch (default: the number of CPUs)')
     args = parser.parse_args()
 
     with open(args.config_file) as config_file:
         config = json.load(config_file)
 
-    table = SqliteTable(config['database'], config['table'])
-    loose = Loose(table, config['constraints'], config['fragments'])
-    associations, dropped = loose.associate(config['k_list'], config.get('skip_probability', 0))
-
+    if isinstance(config, list):
+        if args.insert or args.warm_start:
+            parser.error('--insert and --warm-start need a single configuration')
+        run_batch(config, args.workers)
+        return
+
+    _plan(config)
+
+    # in the published database, the constraints on the other attributes cannot matter
+    if args.insert:
+        from importer import Importer
+        published = Importer(config['output'])
+        table = published.extended_with(SqliteTable(config['database'], args.insert))
+        loose = Loose(table, relevant_constraints(config['constraints'], published.fragments), published.fragments)
+        associations, dropped = loose.resume(config['k_list'], published.associations)
+
+        loose.print_statistics()
+        Exporter(table, published.fragments, associations).update_sqlite(config['output'], published.associations)
+        return
+
+    if args.warm_start:
+        # the rows dropped by the previous run are not in the database
+        from importer import Importer
+        published = Importer(config['output'])
+        loose = Loose(published.table, relevant_constraints(config['constraints'], published.fragments), published.fragments)
+        associations, dropped = loose.warm_start(config['k_list'], published.associations,
+                                                 group_order=config.get('group_order', 'first'))
+
+        loose.print_statistics()
+        Exporter(published.table, published.fragments, associations).update_sqlite(config['output'], published.associations)
+        return
+
+    # the constraints on attributes which are not in any fragment are dropped, see relevant_constraints
+    attributes = set(attribute for fragment in config['fragments'] for attribute in fragment)
+    # the encoded columns are built straight from the cursor, without loading the rows
+    table = SqliteTable(config['database'], config['table'], attributes=attributes, stream=config.get('encode', False),
+                        lazy=config.get('lazy', False), cache_size=config.get('cache_size', 100000))
+    loose, dropped = _associate_and_export(config, table)
     loose.print_statistics()
-    Exporter(table, config['fragments'], associations).to_sqlite(config['output'])
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,86 @@
+from constraints import relevant_constraints
+from loose import Loose
+from math import log, exp
+from tables import SqliteTable
+from time import time
+from utils import k_lists, score
+import sqlite3
+import logging
+
+
+class Planner:
+    '''Choose the k_list of a table by associating random samples of it.
+
+    Every candidate k_list is used on samples of increasing sizes, and the running
+    times are fitted as a power of the number of rows (a line in log-log scale) to
+    predict the time on the whole table. The drop rate is the one of the largest
+    sample. The candidates are ranked by drop rate, then by predicted time, then by
+    the balance score of utils.'''
+
+    def __init__(self, database, tablename, constraints, fragments, sizes=(250, 500, 1000)):
+        database = sqlite3.connect(database) if isinstance(database, basestring) else database
+        self.tuples, = database.execute('SELECT COUNT(*) FROM %s' % tablename).fetchone()
+        attributes = set(attribute for fragment in fragments for attribute in fragment)
+        self._samples = [SqliteTable(database, tablename, attributes=attributes, limit=size)
+                         for size in sorted(set(min(size, self.tuples) for size in sizes))]
+        self._constraints = relevant_constraints(constraints, fragments)
+        self._fragments = fragments
+
+    def estimate(self, k_list, **kwargs):
+        '''returns the predicted seconds and drop rate of the association of the table with k_list'''
+        sizes, seconds = [], []
+        for sample in self._samples:
+            loose = Loose(sample, self._constraints, self._fragments)
+            started = time()
+            associations, dropped = loose.associate(k_list, **kwargs)
+            sizes.append(len(sample))
+            seconds.append(max(time() - started, 1e-6))
+        drop_rate = float(len(dropped)) / max(len(sample), 1)
+        return _fit(sizes, seconds)(self.tuples), drop_rate
+
+    def plan(self, k, **kwargs):
+        '''returns the (k_list, seconds, drop rate) of every k_list enforcing k, best first'''
+        estimates = []
+        for k_list in k_lists(k, len(self._fragments)):
+            seconds, drop_rate = self.estimate(k_list, **kwargs)
+            logging.info('k_list %s: %.1fs, %.3f%% dropped (predicted)' % (k_list, seconds, 100 * drop_rate))
+            estimates.append((k_list, seconds, drop_rate))
+        return sorted(estimates, key=lambda (k_list, seconds, drop_rate): (round(drop_rate, 3), seconds, score(k_list)))
+
+    def best(self, k, **kwargs):
+        return self.plan(k, **kwargs)[0][0]
+
+
+def _fit(xs, ys):
+    '''least squares fit of log y = a + b log x, returns the function predicting y'''
+    xs, ys = map(log, xs), map(log, ys)
+    n, mean_x, mean_y = len(xs), sum(xs) / len(xs), sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    # with a single size the time is assumed linear
+    b = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance if n > 1 and variance else 1.0
+    a = mean_y - b * mean_x
+    return lambda x: exp(a + b * log(x))
+
+
+def main():
+    from argparse import ArgumentParser
+    import json
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = ArgumentParser(description='Predict the cost of the k_lists enforcing a privacy k.')
+    parser.add_argument('config_file', help='JSON configuration file')
+    parser.add_argument('k', type=int, nargs='?', help='privacy k (default: the k of the configuration)')
+    args = parser.parse_args()
+
+    with open(args.config_file) as config_file:
+        config = json.load(config_file)
+
+    planner = Planner(config['database'], config['table'], config['constraints'], config['fragments'],
+                      config.get('plan_sizes', (250, 500, 1000)))
+    logging.disable(logging.INFO)
+    for k_list, seconds, drop_rate in planner.plan(args.k or config['k']):
+        print '{}: {:.1f}s, {:.3%} dropped'.format(k_list, seconds, drop_rate)
+
+if __name__ == '__main__':
+    main()
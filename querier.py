@@ -1,18 +1,81 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import defaultdict, OrderedDict, Counter, deque
+from contextlib import contextmanager
+from Queue import Queue
+from SocketServer import ThreadingMixIn
+from time import time
+from urlparse import urlparse, parse_qs
 import sqlite3
+import threading
 import logging
+import json
 import re
 
 
+_QUOTED = re.compile(r'"[^"]*"|\'[^\']*\'')
+_WHERE = re.compile(r'\bWHERE\b', re.I)
+_WHERE_CLAUSE = re.compile(r'\bWHERE\b(.*?)(?:\bGROUP\s+BY\b|\bORDER\s+BY\b|\bHAVING\b|\bLIMIT\b|$)', re.I | re.S)
+_NOT_PUSHABLE = re.compile(r'\b(?:OR|BETWEEN|SELECT|UNION)\b', re.I)
+_AND = re.compile(r'\bAND\b', re.I)
+_INDEXABLE = re.compile(r'\b(?:WHERE|ON|ORDER\s+BY)\b(.*?)(?=\bGROUP\s+BY\b|\bHAVING\b|\bLIMIT\b|\bORDER\s+BY\b|'
+                        r'\bWHERE\b|\bJOIN\b|\bUNION\b|$)', re.I | re.S)
+_COUNT_BY = re.compile(r'^\s*SELECT\s+\?(\w+)\s*,\s*(?:\?(\w+)\s*,\s*)?COUNT\s*\(\s*\*\s*\)\s+FROM\s+\?\s+'
+                       r'GROUP\s+BY\s+\?(\w+)\s*(?:,\s*\?(\w+)\s*)?;?\s*$', re.I)
+
+
 class Querier:
+    '''Query a loose-associations database.
+
+    The joined tables are materialized on demand and tracked in the joined_tables
+    table: when their total number of rows exceeds budget, the least recently used
+    ones are dropped. Their last uses are kept in memory, in a QuerierState shared
+    by the queriers of a pool. The last cache_size rewritten queries are kept in memory.
+    The counts by one attribute, or by two attributes of different fragments, are
+    answered from the summary tables when the Exporter wrote them.
+    The attributes filtered, joined or sorted on are counted, per table queried: an
+    index is created on those used by index_threshold queries, and dropped when not
+    used by the last index_window queries.'''
 
-    def __init__(self, database, logger=logging.info):
+    RETRIES = 3
+
+    def __init__(self, database, logger=logging.info, budget=None, cache_size=1000, read_only=False, state=None,
+                 index_threshold=3, index_window=1000):
         self._logger = logger or id
-        self.database = sqlite3.connect(database) if isinstance(database, str) else database
+        self.database = (sqlite3.connect(database, cached_statements=cache_size)
+                         if isinstance(database, basestring) else database)
         self.database.isolation_level = None
         self.database.text_factory = str
         self._cursor = self.database.cursor()
+        self._read_only = read_only
+        self._state = state or QuerierState()
         self._schema = self._cursor.execute('SELECT * FROM schema').fetchall()
         self._get_attributes = re.compile(r'\?(\w+)').findall
+        self._fragment_of = dict((attribute, fragment) for attribute, typ, fragment in self._schema)
+        self._summarized = set(name[len('summary_'):] for name, in self._cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'") if name.startswith('summary_'))
+        self._budget = budget
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._index_threshold = index_threshold
+        self._index_window = index_window
+        with self._writing():
+            self._cursor.execute('CREATE TABLE IF NOT EXISTS joined_tables (name TEXT PRIMARY KEY, rows INTEGER, last_used REAL)')
+            for joined, last_used in self._cursor.execute('SELECT name, last_used FROM joined_tables').fetchall():
+                self._state.last_used.setdefault(joined, last_used)
+        if self._read_only:
+            self._cursor.execute('PRAGMA query_only = ON')
+
+    @contextmanager
+    def _writing(self):
+        '''serialize the writes (through the lock shared by the queriers of a pool)'''
+        with self._state.lock:
+            if self._read_only:
+                self._cursor.execute('PRAGMA query_only = OFF')
+            try:
+                yield
+            finally:
+                if self._read_only:
+                    self._cursor.execute('PRAGMA query_only = ON')
 
     def _create_from_clause(self, fragments):
         if not fragments:
@@ -23,59 +86,339 @@ class Querier:
             return 'associations AS A LEFT JOIN ' + ' LEFT JOIN '.join(
                 'fragment_{0} AS F{0} ON A.group_{0} = F{0}.group_{0}'.format(fragment) for fragment in fragments)
 
+    def _single_fragment_predicates(self, sql):
+        '''returns the conjuncts of the WHERE clause that touch a single fragment, by fragment.
+        Only plain conjunctions are considered, anything fancier is left to the join.'''
+        predicates = defaultdict(list)
+        if len(_WHERE.findall(_QUOTED.sub('', sql))) != 1:
+            return predicates
+        # the bounds of the clause are found with the literals masked, keeping the offsets
+        masked = _QUOTED.sub(lambda literal: '_' * len(literal.group()), sql)
+        where = sql[slice(*_WHERE_CLAUSE.search(masked).span(1))]
+        unquoted = _QUOTED.sub('', where)
+        if ('(' in unquoted or _NOT_PUSHABLE.search(unquoted) or _WHERE.search(where)
+                or len(_AND.findall(unquoted)) != len(_AND.findall(where))):
+            return predicates
+        for conjunct in _AND.split(where):
+            fragments = set(self._fragment_of.get(attribute) for attribute in self._get_attributes(conjunct))
+            if len(fragments) == 1 and None not in fragments:
+                predicates[fragments.pop()].append(conjunct.replace('?', '').strip())
+        return predicates
+
+    def _create_pushed_down_table(self, fragments, predicates):
+        '''returns a subquery joining the fragments through associations, starting from the
+        rows of the fragments satisfying their own predicates'''
+        attributes = ', '.join(attribute for attribute, typ, fragment in self._schema if fragment in fragments)
+        filtered = sorted(predicates)
+        tables = ['(SELECT * FROM fragment_{0} WHERE {1}) AS F{0}'.format(fragment, ' AND '.join(predicates[fragment]))
+                  for fragment in filtered]
+        joins = ' '.join(['JOIN associations AS A ON A.group_{0} = F{0}.group_{0}'.format(filtered[0])] +
+            ['JOIN {1} ON A.group_{0} = F{0}.group_{0}'.format(fragment, table)
+             for fragment, table in zip(filtered, tables)[1:]] +
+            ['LEFT JOIN fragment_{0} AS F{0} ON A.group_{0} = F{0}.group_{0}'.format(fragment)
+             for fragment in sorted(fragments) if fragment not in predicates])
+        return '(SELECT {} FROM {} {}) AS pushed'.format(attributes, tables[0], joins)
+
+    def _touch(self, joined):
+        '''mark joined as used now, returning False if it is not materialized'''
+        if joined not in self._state.last_used:
+            return False
+        self._state.last_used[joined] = time()
+        return True
+
     def _get_joined_table(self, fragments):
         if not fragments:
             return ''
         
         joined = 'joined_' + '_'.join(map(str, fragments))
+        if self._touch(joined):
+            return joined
 
-        # check if the joined table already exists (sqlite-dependant)
-        if not self._cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='%s'" % joined).fetchall():
-            logging.info('creating joined table %s' % joined)
-            attributes = filter(lambda attr: attr[2] in fragments, self._schema)
-            self._cursor.execute('CREATE TABLE {} ({})'.format(joined,
-                ', '.join('%s %s' % (attribute, typ) for attribute, typ, fragment in attributes)))
-            self._cursor.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2}'.format(joined,
-                ', '.join('%s' % attribute for attribute, typ, fragment in attributes), self._create_from_clause(fragments)))
+        with self._writing():
+            if not self._touch(joined):
+                # in a single transaction, so that the other connections never see the table half filled
+                self._cursor.execute('BEGIN')
+                # check if the joined table already exists (sqlite-dependant)
+                if not self._cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='%s'" % joined).fetchall():
+                    logging.info('creating joined table %s' % joined)
+                    self._forget_indexes(joined)
+                    attributes = filter(lambda attr: attr[2] in fragments, self._schema)
+                    self._cursor.execute('CREATE TABLE {} ({})'.format(joined,
+                        ', '.join('%s %s' % (attribute, typ) for attribute, typ, fragment in attributes)))
+                    self._cursor.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2}'.format(joined,
+                        ', '.join('%s' % attribute for attribute, typ, fragment in attributes), self._create_from_clause(fragments)))
+                rows, = self._cursor.execute('SELECT COUNT(*) FROM %s' % joined).fetchone()
+                self._cursor.execute('INSERT OR REPLACE INTO joined_tables VALUES (?, ?, ?)', (joined, rows, time()))
+                self._evict(joined)
+                self._cursor.execute('COMMIT')
+                self._state.last_used[joined] = time()
         return joined
 
-    def query(self, sql):
-        '''Parse the query and expand the question-marked syntax'''
+    def _evict(self, keep):
+        '''drop the least recently used joined tables (but keep) until they fit in the budget'''
+        if self._budget is None:
+            return
+        tables = self._cursor.execute('SELECT name, rows, last_used FROM joined_tables').fetchall()
+        total = sum(rows for joined, rows, last_used in tables)
+        for last_used, joined, rows in sorted((self._state.last_used.get(joined, last_used), joined, rows)
+                                              for joined, rows, last_used in tables if joined != keep):
+            if total <= self._budget:
+                break
+            logging.info('dropping joined table %s' % joined)
+            self._state.last_used.pop(joined, None)
+            self._cursor.execute('DROP TABLE IF EXISTS %s' % joined)
+            self._cursor.execute('DELETE FROM joined_tables WHERE name = ?', (joined,))
+            self._forget_indexes(joined)
+            total -= rows
+
+    def _indexable(self, sql, fragments, joined, predicates):
+        '''returns the (table, attribute) pairs of the attributes filtered, joined or sorted on'''
+        attributes = set(attribute for clause in _INDEXABLE.findall(_QUOTED.sub('', sql))
+                         for attribute in self._get_attributes(clause) if attribute in self._fragment_of)
+        if joined:
+            return [(joined, attribute) for attribute in sorted(attributes)]
+        return [('fragment_%i' % self._fragment_of[attribute], attribute) for attribute in sorted(attributes)
+                if self._fragment_of[attribute] in predicates]
+
+    def _use_indexes(self, indexable):
+        '''count the uses of the attributes, indexing the ones crossing the threshold and
+        dropping the indexes not used in the window'''
+        if self._index_threshold is None:
+            return
+        state = self._state
+        with state.lock:
+            state.queries += 1
+            created = []
+            for target in indexable:
+                state.usage[target] += 1
+                state.used_at[target] = state.queries
+                if target not in state.indexes and state.usage[target] >= self._index_threshold:
+                    state.indexes.add(target)
+                    created.append(target)
+            dropped = []
+            if not state.queries % 100:
+                dropped = [target for target in state.indexes if state.used_at[target] <= state.queries - self._index_window]
+                for target in dropped:
+                    self._forget_indexes(*target)
+        for target in created:
+            if not self._index(target, 'CREATE INDEX IF NOT EXISTS auto_{0}_{1} ON {0} ({1})', 'created'):
+                with state.lock:
+                    state.indexes.discard(target)
+        for target in dropped:
+            self._index(target, 'DROP INDEX IF EXISTS auto_{0}_{1}', 'dropped')
+
+    def _index(self, (table, attribute), statement, decision):
+        with self._writing():
+            try:
+                self._cursor.execute(statement.format(table, attribute))
+            except sqlite3.OperationalError:
+                # the joined table was evicted by another querier meanwhile
+                return False
+        logging.info('%s index on %s (%s)' % (decision, table, attribute))
+        self._state.decisions.append((time(), decision, table, attribute))
+        return True
+
+    def _forget_indexes(self, table, attribute=None):
+        '''forget the indexes of table (on attribute only, if given) and their uses, holding the lock'''
+        state = self._state
+        for target in [target for target in state.indexes if target[0] == table and attribute in (None, target[1])]:
+            state.indexes.discard(target)
+            state.usage.pop(target, None)
+
+    def stats(self):
+        return self._state.stats()
+
+    def _summary_query(self, sql):
+        '''returns the query on the summary tables answering sql, if it is a count by attributes'''
+        match = _COUNT_BY.match(sql)
+        if not match:
+            return None
+        selected = filter(None, match.groups()[:2])
+        if (sorted(selected) != sorted(filter(None, match.groups()[2:])) or len(set(selected)) != len(selected)
+                or not self._summarized.issuperset(selected)):
+            return None
+        if len(selected) == 1:
+            return 'SELECT value, SUM(count) FROM summary_%s GROUP BY value' % selected[0]
+        fragments = map(self._fragment_of.get, selected)
+        if fragments[0] == fragments[1]:
+            return None
+        # every association stands for the product of the rows of its groups
+        return ('SELECT S0.value, S1.value, SUM(S0.count * S1.count) FROM associations AS A '
+                'JOIN summary_{0} AS S0 ON S0.group_id = A.group_{1} JOIN summary_{2} AS S1 ON S1.group_id = A.group_{3} '
+                'GROUP BY S0.value, S1.value').format(selected[0], fragments[0], selected[1], fragments[1])
+
+    def _rewrite(self, sql):
+        '''returns the query with the question-marked syntax expanded, the joined table it uses
+        and the attributes it could use an index on'''
+        summary = self._summary_query(sql)
+        if summary:
+            return summary, '', []
+
         # select the fragments in which the question-marked attributes are stored
         attributes = self._get_attributes(sql)
         fragments = set(fragment for (attribute, typ, fragment) in self._schema if attribute in attributes)
-        tables = self._get_joined_table(fragments)
+
+        # when some fragment can be filtered on its own, join only the matching groups
+        predicates = self._single_fragment_predicates(sql) if len(fragments) > 1 else None
+        if predicates:
+            joined, tables = '', self._create_pushed_down_table(fragments, predicates)
+        else:
+            joined = tables = self._get_joined_table(fragments)
 
         # replace question-marked syntax with the generated sql syntax
-        sql = ' '.join(sql.replace('? ', tables + ' ').replace('?', '').split())
-        self._logger(sql)
-        return self._cursor.execute(sql).fetchall()
+        rewritten = ' '.join(sql.replace('? ', tables + ' ').replace('?', '').split())
+        return rewritten, joined, self._indexable(sql, fragments, joined, predicates)
+
+    def query(self, sql):
+        '''Parse the query and expand the question-marked syntax'''
+        if sql in self._cache:
+            rewritten, joined, indexable = self._cache.pop(sql)
+            if joined and not self._touch(joined):
+                rewritten, joined, indexable = self._rewrite(sql)
+        else:
+            rewritten, joined, indexable = self._rewrite(sql)
+            if len(self._cache) >= self._cache_size:
+                self._cache.popitem(last=False)
+        self._cache[sql] = rewritten, joined, indexable
+        self._use_indexes(indexable)
+
+        self._logger(rewritten)
+        for attempt in xrange(self.RETRIES):
+            try:
+                return self._cursor.execute(rewritten).fetchall()
+            except sqlite3.OperationalError:
+                if not joined or attempt == self.RETRIES - 1:
+                    raise
+                # the joined table may have been evicted by another querier meanwhile
+                with self._state.lock:
+                    self._state.last_used.pop(joined, None)
+                    self._forget_indexes(joined)
+                rewritten, joined, indexable = self._cache[sql] = self._rewrite(sql)
 
     def print_query(self, *args):
         for t in self.query(*args):
             print ' | '.join(str(x) for x in t)
 
 
+class QuerierState:
+    '''The state shared by the queriers of a database: the lock serializing their writes,
+    the last use of every joined table, and the uses of the attributes with the indexes
+    created on them. Everything but the last uses is changed holding the lock.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_used = {}
+        self.queries = 0
+        self.usage = Counter()
+        self.used_at = {}
+        self.indexes = set()
+        self.decisions = deque(maxlen=1000)
+
+    def stats(self):
+        '''returns the uses of the attributes, the indexes created and the last decisions taken'''
+        with self.lock:
+            return dict(queries=self.queries,
+                        usage=sorted(('%s.%s' % target, uses) for target, uses in self.usage.iteritems()),
+                        indexes=sorted('%s.%s' % target for target in self.indexes),
+                        decisions=list(self.decisions))
+
+
+class QuerierPool:
+    '''Queriers on their own read-only connections, sharing a QuerierState'''
+
+    def __init__(self, database, size, **kwargs):
+        self._state = QuerierState()
+        self._queriers = Queue()
+        for _ in xrange(size):
+            connection = sqlite3.connect(database, check_same_thread=False, timeout=60,
+                                         cached_statements=kwargs.get('cache_size', 1000))
+            # readers do not block the writer (and vice versa) in WAL mode
+            connection.execute('PRAGMA journal_mode = WAL')
+            self._queriers.put(Querier(connection, read_only=True, state=self._state, **kwargs))
+
+    def query(self, sql):
+        querier = self._queriers.get()
+        try:
+            return querier.query(sql)
+        finally:
+            self._queriers.put(querier)
+
+    def stats(self):
+        return self._state.stats()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''Answer GET /query?sql=... with the JSON list of the resulting rows, and GET /stats
+    with the stats of the pool'''
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        sql = parse_qs(url.query).get('sql')
+        if url.path == '/stats':
+            code, body = 200, json.dumps(self.server.pool.stats())
+        elif url.path != '/query' or not sql:
+            return self.send_error(404, 'use /query?sql=...')
+        else:
+            try:
+                code, body = 200, json.dumps(self.server.pool.query(sql[0]))
+            except sqlite3.Error, e:
+                code, body = 400, json.dumps({'error': e.args[0]})
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+class QueryServer(ThreadingMixIn, HTTPServer):
+    '''HTTP server answering the queries concurrently from a QuerierPool'''
+
+    daemon_threads = True
+
+    def __init__(self, address, pool):
+        HTTPServer.__init__(self, address, QueryHandler)
+        self.pool = pool
+
+
 def main():
     from argparse import ArgumentParser
 
     parser = ArgumentParser(description='Query the loose-associations database easily.')
     parser.add_argument('database', help='loose-associations database')
+    parser.add_argument('--budget', type=int, help='maximum number of rows kept in the joined tables')
+    parser.add_argument('--index-threshold', type=int, default=3,
+                        help='queries using an attribute before it is indexed, 0 to disable (default: 3)')
+    parser.add_argument('--serve', metavar='PORT', type=int, help='serve the queries over HTTP on PORT')
+    parser.add_argument('--connections', type=int, default=8, help='connections used when serving (default: 8)')
     args = parser.parse_args()
 
+    if args.serve:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        pool = QuerierPool(args.database, args.connections, budget=args.budget, logger=None,
+                           index_threshold=args.index_threshold or None)
+        print 'Serving GET /query?sql=... on port %i' % args.serve
+        QueryServer(('localhost', args.serve), pool).serve_forever()
+        return
+
     print 'Enter your queries using ? before loose attributes and \'FROM ?\' to auto-join.'
     print 'example:  SELECT ?disease FROM ? WHERE ?name = "Alice"'
-    print 'Enter a blank line to exit.'
+    print 'Enter .stats to see the automatic indexes, a blank line to exit.'
 
-    querier = Querier(args.database)
+    querier = Querier(args.database, budget=args.budget, index_threshold=args.index_threshold or None)
 
     while True:
         query = raw_input('> ')
         if query == '':
             break
+        if query == '.stats':
+            print json.dumps(querier.stats(), indent=2)
+            continue
         try:
             querier.print_query(query)
-        except Error, e:
+        except sqlite3.Error, e:
             print 'An error occurred:', e.args[0]
 
 if __name__ == '__main__':
@@ -0,0 +1,53 @@
+from collections import Counter, OrderedDict
+from functools import wraps
+from time import time
+import json
+
+
+class Stats:
+    '''Counters and timers of a run of Loose.
+
+    The methods to measure are wrapped only when a Stats object is attached, so
+    that a run without it pays nothing for the instrumentation.'''
+
+    def __init__(self):
+        self.counts = Counter()
+        self.times = Counter()
+        self.rejections = Counter()
+        self.phases = OrderedDict()
+        self.extensions = Counter()
+        self.backtracks = Counter()
+        self.max_extensions_per_row = 0
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def check(self, name, fn):
+        '''wrap a heterogenity check, counting calls, time and rejections'''
+        @wraps(fn)
+        def _check(*args):
+            started = time()
+            result = fn(*args)
+            self.times[name] += time() - started
+            self.counts[name] += 1
+            if not result:
+                self.rejections[name] += 1
+            return result
+        return _check
+
+    def update(self, other):
+        '''add the counters and timers of other (e.g. collected by a worker process)'''
+        for name in ('counts', 'times', 'rejections', 'extensions', 'backtracks'):
+            getattr(self, name).update(getattr(other, name))
+        for phase, seconds in other.phases.iteritems():
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+        self.max_extensions_per_row = max(self.max_extensions_per_row, other.max_extensions_per_row)
+
+    def as_dict(self):
+        return dict(counts=self.counts, times=self.times, rejections=self.rejections, phases=self.phases,
+                    extensions=self.extensions, backtracks=self.backtracks,
+                    max_extensions_per_row=self.max_extensions_per_row)
+
+    def dump(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.as_dict(), output, indent=2)
@@ -1,8 +1,19 @@
-from collections import defaultdict
+from array import array
+from collections import defaultdict, OrderedDict
+from itertools import izip
 from operator import itemgetter
 from math import log
+from utils import placeholders
 import sqlite3
 import random
+import json
+import os
+
+try:
+    import numpy
+    from numpy.lib.format import open_memmap
+except ImportError:
+    numpy = None
 
 
 class BaseTable:
@@ -12,7 +23,7 @@ class BaseTable:
 
     def __iter__(self):
         for i in xrange(self._tuples):
-            yield self._table[i]
+            yield self[i]
 
     def __getitem__(self, key):
         return self._table[key]
@@ -22,7 +33,11 @@ class BaseTable:
         return [a if isinstance(a, int) else names.index(a) for a in attrs]
 
     def to_names(self, attrs):
-        return [a if isinstance(a, str) else self.attributes[a][0] for a in attrs]
+        return [a if isinstance(a, basestring) else self.attributes[a][0] for a in attrs]
+
+    def materialized(self):
+        '''returns a table with the same rows which every forked process reads alike'''
+        return self
 
 
 class ListTable(BaseTable):
@@ -34,52 +49,262 @@ class ListTable(BaseTable):
 
 
 class SqliteTable(BaseTable):
+    '''Table loaded from sqlite3.
+
+    Only the attributes listed in the attributes keyword (all of them by default)
+    are selected, and the rows are fetched in chunks of chunk_size. With lazy=True
+    only the rowids are loaded upfront, and the rows are fetched on demand in blocks
+    and kept in an LRU cache of cache_size rows. With stream=True nothing is loaded:
+    the table can only be iterated, fetching the rows in chunks every time (e.g. to
+    build an EncodedTable without a copy of the rows).'''
 
     def __init__(self, database, tablename, **kwargs):
-        database = sqlite3.connect(database) if isinstance(database, str) else database
+        database = sqlite3.connect(database) if isinstance(database, basestring) else database
         database.text_factory = str
         cursor = database.cursor()
         self.attributes = map(itemgetter(1, 2), cursor.execute('pragma table_info(%s)' % tablename).fetchall())
 
+        attributes = kwargs.get('attributes', None)
+        if attributes is not None:
+            self.attributes = [self.attributes[i] for i in sorted(set(self.to_indices(attributes)))]
+        columns = ', '.join(self.to_names(xrange(len(self.attributes))))
+
 
         limit = kwargs.get('limit', None)
         if 'limit' in kwargs:
-            query = 'SELECT * FROM (SELECT * FROM %s ORDER BY random() LIMIT %i)' % (tablename, limit)
+            source, rowid = '(SELECT rowid AS rowid_, * FROM %s ORDER BY random() LIMIT %i)' % (tablename, limit), 'rowid_'
         else:
-            query = 'SELECT * FROM %s' % tablename
+            source, rowid = tablename, 'rowid'
 
 
         order_by = kwargs.get('order_by', None)
-        if 'order_by' in kwargs:
-            query += ' ORDER BY ' + ', '.join(self.to_names(order_by))
+        order = ' ORDER BY ' + ', '.join(self.to_names(order_by)) if 'order_by' in kwargs else ''
 
-        self._table = cursor.execute(query).fetchall()
+        chunk_size = kwargs.get('chunk_size', 10000)
+        if kwargs.get('stream', False):
+            self._cursor, self._chunk_size = cursor, chunk_size
+            self._select = 'SELECT %s FROM %s%s' % (columns, source, order)
+            self._tuples, = cursor.execute('SELECT COUNT(*) FROM %s' % source).fetchone()
+            self._table = None
+            return
+        if kwargs.get('lazy', False):
+            cursor.execute('SELECT %s FROM %s%s' % (rowid, source, order))
+            rowids = array('l')
+            for chunk in iter(lambda: cursor.fetchmany(chunk_size), []):
+                rowids.extend(r for r, in chunk)
+            path = database.execute('PRAGMA database_list').fetchone()[2]
+            self._table = LazyRows(cursor, path, tablename, columns, rowids, kwargs.get('cache_size', 100000))
+        else:
+            cursor.execute('SELECT %s FROM %s%s' % (columns, source, order))
+            self._table = []
+            for chunk in iter(lambda: cursor.fetchmany(chunk_size), []):
+                self._table.extend(chunk)
         self._tuples = len(self._table)
 
+    def materialized(self):
+        # the rows of a database in memory cannot be fetched again in a forked process
+        if isinstance(self._table, LazyRows) and not self._table.path:
+            return ListTable(self.attributes, list(self))
+        return self
+
+    def __iter__(self):
+        if self._table is not None:
+            return BaseTable.__iter__(self)
+        self._cursor.execute(self._select)
+        return (row for chunk in iter(lambda: self._cursor.fetchmany(self._chunk_size), []) for row in chunk)
+
+
+class LazyRows:
+    '''Rows of a sqlite3 table fetched by rowid in blocks and kept in an LRU cache.
+
+    A forked process opens its own connection to path, since a connection cannot be
+    shared with the parent.'''
+
+    BLOCK = 500
+
+    def __init__(self, cursor, path, tablename, columns, rowids, cache_size):
+        self._cursor = cursor
+        self._pid = os.getpid()
+        self.path = path
+        self._query = 'SELECT rowid, %s FROM %s WHERE rowid IN (%%s)' % (columns, tablename)
+        self._rowids = rowids
+        self._cache = OrderedDict()
+        self._cache_size = max(cache_size, self.BLOCK)
+
+    def __len__(self):
+        return len(self._rowids)
+
+    def __getitem__(self, key):
+        if key < 0:
+            key += len(self._rowids)
+        try:
+            row = self._cache.pop(key)
+        except KeyError:
+            self._fetch(key)
+            row = self._cache.pop(key)
+        self._cache[key] = row
+        return row
+
+    def _fetch(self, key):
+        '''fetch the block of rows starting from key, which are likely to be read next'''
+        keys = [k for k in xrange(key, min(key + self.BLOCK, len(self._rowids))) if k == key or k not in self._cache]
+        positions = dict((self._rowids[k], k) for k in keys)
+        query = self._query % placeholders(len(keys))
+        if self._pid != os.getpid():
+            database = sqlite3.connect(self.path)
+            database.text_factory = str
+            self._cursor, self._pid = database.cursor(), os.getpid()
+        for row in self._cursor.execute(query, [self._rowids[k] for k in keys]):
+            self._cache[positions[row[0]]] = row[1:]
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+
+class SlicedTable(BaseTable):
+    '''View of the rows [start, stop) of another table'''
+
+    def __init__(self, table, start, stop):
+        self.attributes = table.attributes
+        self._table = table
+        self._start = start
+        self._tuples = stop - start
+
+    def __getitem__(self, key):
+        return self._table[self._start + key]
+
+
+class EncodedTable(BaseTable):
+    '''Columnar copy of a table in which every value is replaced by a small integer.
+
+    Rows are returned as tuples of codes, so that comparisons are integer compares,
+    while the decoded attribute exposes the original values (e.g. for the Exporter).'''
+
+    def __init__(self, table):
+        self.attributes = table.attributes
+        self._tuples = len(table)
+        self._values = [[] for _ in self.attributes]
+        self._columns = [array('i') for _ in self.attributes]
+
+        codes = [{} for _ in self.attributes]
+        for row in table:
+            for value, column, code, values in izip(row, self._columns, codes, self._values):
+                if value not in code:
+                    code[value] = len(values)
+                    values.append(value)
+                column.append(code[value])
+
+        self.decoded = DecodedTable(self)
+
+    def __getitem__(self, key):
+        return tuple(column[key] for column in self._columns)
+
+    def decode(self, row):
+        return tuple(values[code] for values, code in izip(self._values, row))
+
+    def pack(self, row, attrs):
+        '''returns the codes of attrs in row (a row of this table) packed in a single integer'''
+        packed = 0
+        for attr in attrs:
+            packed = packed * len(self._values[attr]) + row[attr]
+        return packed
+
+
+class DecodedTable(BaseTable):
+    '''View of an EncodedTable returning the original values'''
+
+    def __init__(self, encoded):
+        self.attributes = encoded.attributes
+        self._tuples = len(encoded)
+        self._encoded = encoded
+
+    def __getitem__(self, key):
+        return self._encoded.decode(self._encoded[key])
+
 
 class BaseGeneratedTable(BaseTable):
+    '''Table of generated values.
 
-    def __init__(self, tuples, attrs, generator):
+    Without a seed the rows are generated on demand with the random module. With a
+    seed they are all generated upfront, in bulk with numpy when it is available.
+    With a path the numpy array is written there (or loaded, if the file exists)
+    and memory mapped, so that a large table is generated once and reused. The
+    parameters of the table are written next to it, in path.json, and a stored
+    table is reused only when they are the same.'''
+
+    CHUNK = 1000000
+
+    def __init__(self, tuples, attrs, generator, sampler, seed=None, path=None, params={}):
         self._tuples = tuples
-        self._table = defaultdict(lambda: tuple(generator() for _ in xrange(attrs)))
         self.attributes = [('attr_%i' % i, 'INTEGER') for i in xrange(attrs)]
+        if path is not None or (seed is not None and numpy is not None):
+            if numpy is None:
+                raise ImportError('numpy is needed to store a generated table')
+            params = dict(params, table=self.__class__.__name__, tuples=tuples, attrs=attrs, seed=seed)
+            self._table = self._generate(tuples, attrs, sampler, seed, path, params)
+        elif seed is not None:
+            rng = random.Random(seed)
+            self._table = [tuple(generator(rng) for _ in xrange(attrs)) for _ in xrange(tuples)]
+        else:
+            self._table = defaultdict(lambda: tuple(generator(random) for _ in xrange(attrs)))
+
+    def _generate(self, tuples, attrs, sampler, seed, path, params):
+        '''returns the (tuples, attrs) array of the table, generated in chunks of rows'''
+        if path is not None and os.path.exists(path):
+            stored = None
+            if os.path.exists(path + '.json'):
+                with open(path + '.json') as stored_file:
+                    stored = json.load(stored_file)
+            if stored != params:
+                raise ValueError('%s holds a table generated with %s, not %s' % (path, stored, params))
+            return numpy.load(path, mmap_mode='r')
+        if path is None:
+            table = numpy.empty((tuples, attrs), dtype=numpy.int64)
+        else:
+            table = open_memmap(path, mode='w+', dtype=numpy.int64, shape=(tuples, attrs))
+        rng = numpy.random.RandomState(seed)
+        for start in xrange(0, tuples, self.CHUNK):
+            stop = min(start + self.CHUNK, tuples)
+            table[start:stop] = sampler(rng, (stop - start, attrs))
+        if path is None:
+            return table
+        table.flush()
+        del table
+        with open(path + '.json', 'w') as params_file:
+            json.dump(params, params_file, sort_keys=True)
+        return numpy.load(path, mmap_mode='r')
+
+    def __getitem__(self, key):
+        row = self._table[key]
+        return row if isinstance(row, tuple) else tuple(row.tolist())
+
+    def materialized(self):
+        # the rows generated on demand would be different in every forked process
+        if isinstance(self._table, defaultdict):
+            return ListTable(self.attributes, list(self))
+        return self
 
 
 class RandomTable(BaseGeneratedTable):
 
-    def __init__(self, tuples, attrs, maxvalue=100):
-        BaseGeneratedTable.__init__(self, tuples, attrs, lambda: random.randint(1, maxvalue))
+    def __init__(self, tuples, attrs, maxvalue=100, **kwargs):
+        BaseGeneratedTable.__init__(self, tuples, attrs,
+            lambda rng: rng.randint(1, maxvalue),
+            lambda rng, size: rng.randint(1, maxvalue + 1, size), params=dict(maxvalue=maxvalue), **kwargs)
 
 
 class SelfSimilarTable(BaseGeneratedTable):
 
-    def __init__(self, tuples, attrs, coeff=0.5, maxvalue=100):
+    def __init__(self, tuples, attrs, coeff=0.5, maxvalue=100, **kwargs):
+        exponent = log(coeff) / log(1.0 - coeff)
         BaseGeneratedTable.__init__(self, tuples, attrs,
-            lambda: int(maxvalue * (random.random() ** (log(coeff) / log(1.0 - coeff)))))
+            lambda rng: int(maxvalue * (rng.random() ** exponent)),
+            lambda rng, size: (maxvalue * rng.random_sample(size) ** exponent).astype(numpy.int64),
+            params=dict(coeff=coeff, maxvalue=maxvalue), **kwargs)
 
 
 class GaussianTable(BaseGeneratedTable):
 
-    def __init__(self, tuples, attrs, mu=0, sigma=10):
+    def __init__(self, tuples, attrs, mu=0, sigma=10, **kwargs):
         BaseGeneratedTable.__init__(self, tuples, attrs,
-            lambda: int(random.gauss(mu, sigma)))
+            lambda rng: int(rng.gauss(mu, sigma)),
+            lambda rng, size: rng.normal(mu, sigma, size).astype(numpy.int64), params=dict(mu=mu, sigma=sigma), **kwargs)
@@ -0,0 +1,109 @@
+from associations import Associations, CompactAssociations, FreeGroups
+from worklist import Worklist
+import random
+import unittest
+
+
+class FreeGroupsTest(unittest.TestCase):
+
+    def test_next_free(self):
+        random.seed(1)
+        fulls, bitmap = set(), FreeGroups()
+        for _ in xrange(20000):
+            group_id = random.randrange(10000)
+            if group_id in fulls:
+                fulls.remove(group_id)
+                bitmap.remove(group_id)
+            else:
+                fulls.add(group_id)
+                bitmap.add(group_id)
+        for group_id in range(0, 10100, 7):
+            self.assertEqual(group_id in bitmap, group_id in fulls)
+            expected = next(g for g in xrange(group_id, 20000) if g not in fulls)
+            self.assertEqual(bitmap.next_free(group_id), expected)
+
+    def test_long_full_run(self):
+        bitmap = FreeGroups()
+        for group_id in xrange(64 * 64 * 2 + 5):
+            bitmap.add(group_id)
+        self.assertEqual(bitmap.next_free(0), 64 * 64 * 2 + 5)
+        bitmap.remove(5000)
+        self.assertEqual(bitmap.next_free(0), 5000)
+
+
+class StoresTest(unittest.TestCase):
+    '''both stores are driven by the same random operations and must agree with a plain dict'''
+
+    ROWS = 500
+
+    def setUp(self):
+        random.seed(2)
+        self.k_list = [3, 2]
+        self.stores = [Associations(self.k_list), CompactAssociations(self.k_list, self.ROWS)]
+        self.expected = {}
+        for _ in xrange(3000):
+            row_id = random.randrange(self.ROWS)
+            if random.random() < 0.3:
+                self.expected.pop(row_id, None)
+                for store in self.stores:
+                    del store[row_id]
+            else:
+                association = (random.randrange(150), random.randrange(200))
+                self.expected[row_id] = association
+                for store in self.stores:
+                    store[row_id] = association
+
+    def group(self, fragment_id, group_id):
+        return set(row_id for row_id, association in self.expected.iteritems() if association[fragment_id] == group_id)
+
+    def test_groups(self):
+        for store in self.stores:
+            self.assertEqual(dict((row_id, store[row_id]) for row_id in store.keys()), self.expected)
+            for fragment_id, k in enumerate(self.k_list):
+                for group_id in xrange(210):
+                    group = self.group(fragment_id, group_id)
+                    self.assertEqual(store.get_group(fragment_id, group_id), group)
+                    self.assertEqual(store.is_group_full(fragment_id, group_id), len(group) >= k)
+
+    def test_exists(self):
+        for store in self.stores:
+            for _ in xrange(500):
+                group1, group2 = random.randrange(150), random.randrange(200)
+                expected = any(association == (group1, group2) for association in self.expected.itervalues())
+                self.assertEqual(store.exists(0, group1, 1, group2), expected)
+
+    def test_nonfull_groups_by_size(self):
+        for store in self.stores:
+            for fragment_id, k in enumerate(self.k_list):
+                ascending = list(store.iter_nonfull_groups(fragment_id, 10, 160))
+                for fullest in (False, True):
+                    groups = list(store.iter_nonfull_groups_by_size(fragment_id, 10, 160, fullest))
+                    self.assertEqual(sorted(groups), ascending)
+                    sizes = [store.get_group_size(fragment_id, group_id) for group_id in groups]
+                    nonempty = [size for size in sizes if size]
+                    # the empty groups come last
+                    self.assertEqual(sizes, nonempty + [0] * (len(sizes) - len(nonempty)))
+                    self.assertEqual(nonempty, sorted(nonempty, reverse=fullest))
+
+
+class WorklistTest(unittest.TestCase):
+
+    def test_order(self):
+        worklist = Worklist()
+        self.assertTrue(worklist.push('a', 2, 'first'))
+        self.assertTrue(worklist.push('b', 1, 'second'))
+        self.assertTrue(worklist.push('c', 2, 'third'))
+        self.assertEqual([worklist.pop() for _ in xrange(3)],
+                         [('b', 1, 'second'), ('c', 2, 'third'), ('a', 2, 'first')])
+
+    def test_coalesce(self):
+        worklist = Worklist()
+        worklist.push('a', 2, 'first')
+        self.assertFalse(worklist.push('a', 3, 'lower'))
+        self.assertFalse(worklist.push('a', 1, 'higher'))
+        self.assertEqual(len(worklist), 1)
+        self.assertEqual(worklist.pop(), ('a', 1, 'first'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+from collections import defaultdict
+from itertools import combinations
+from loose import Loose
+from tables import ListTable, RandomTable, SelfSimilarTable
+import logging
+import random
+import unittest
+
+
+CONSTRAINTS = [[0, 1], [2, 3], [0, 3]]
+FRAGMENTS = [[0, 2], [1, 3]]
+K_LIST = [3, 3]
+
+
+def violations(table, constraints, fragments, associations, k_list):
+    '''returns the groups smaller than k, the pairs of alike rows in a group and the pairs
+    of groups associated more than once, checked by brute force'''
+    groups = [defaultdict(list) for _ in fragments]
+    pairs = defaultdict(int)
+    for row_id, association in associations.items():
+        if association:
+            for fragment_id, group_id in enumerate(association):
+                groups[fragment_id][group_id].append(row_id)
+            for fragment1, fragment2 in combinations(xrange(len(association)), 2):
+                pairs[fragment1, association[fragment1], fragment2, association[fragment2]] += 1
+
+    found = []
+    for fragment_id, fragment in enumerate(fragments):
+        for group_id, rows in groups[fragment_id].iteritems():
+            if len(rows) < k_list[fragment_id]:
+                found.append(('undersized', fragment_id, group_id))
+            for row1, row2 in combinations(rows, 2):
+                for constraint in constraints:
+                    attributes = set(constraint) & set(fragment)
+                    if attributes and all(table[row1][a] == table[row2][a] for a in attributes):
+                        found.append(('alike', fragment_id, row1, row2))
+    found.extend(('associated', pair) for pair, count in pairs.iteritems() if count > 1)
+    return found
+
+
+def seeded(table_class, tuples, seed):
+    random.seed(seed)
+    table = table_class(tuples, 4)
+    return ListTable(table.attributes, [table[i] for i in xrange(tuples)])
+
+
+class AssociateTest(unittest.TestCase):
+
+    TUPLES = 300
+
+    def setUp(self):
+        logging.disable(logging.INFO)
+        self.tables = [seeded(RandomTable, self.TUPLES, 1), seeded(SelfSimilarTable, self.TUPLES, 2)]
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def check(self, table, associations, dropped, k_list=K_LIST):
+        self.assertEqual(violations(table, CONSTRAINTS, FRAGMENTS, associations, k_list), [])
+        associated = set(row_id for row_id, association in associations.items() if association)
+        self.assertEqual(associated | set(dropped), set(xrange(len(table))))
+        self.assertLessEqual(len(dropped), len(table) // 10)
+
+    def associate(self, **kwargs):
+        for table in self.tables:
+            for k_list in (K_LIST, [2, 2]):
+                associations, dropped = Loose(table, CONSTRAINTS, FRAGMENTS).associate(k_list, **kwargs)
+                self.check(table, associations, dropped, k_list)
+
+    def test_first(self):
+        self.associate()
+
+    def test_compact(self):
+        self.associate(compact=True)
+
+    def test_group_orders(self):
+        for group_order in ('fullest', 'emptiest'):
+            self.associate(group_order=group_order)
+            self.associate(group_order=group_order, compact=True)
+
+    def test_compact_is_the_same(self):
+        for table in self.tables:
+            associations, dropped = Loose(table, CONSTRAINTS, FRAGMENTS).associate(K_LIST)
+            compact, compact_dropped = Loose(table, CONSTRAINTS, FRAGMENTS).associate(K_LIST, compact=True)
+            self.assertEqual(dict(associations.iteritems()), dict(compact.iteritems()))
+            self.assertEqual(dropped, compact_dropped)
+
+    def test_row_orders(self):
+        self.associate(seed=3)
+        self.associate(row_order='frequent', presolve=True)
+
+    def test_budget(self):
+        self.associate(budget=2)
+
+    def test_in_parallel(self):
+        for table in self.tables:
+            associations, dropped = Loose(table, CONSTRAINTS, FRAGMENTS).associate_in_parallel(K_LIST, 2)
+            self.check(table, associations, dropped)
+
+    def test_with_seeds(self):
+        for table in self.tables:
+            associations, dropped, seed = Loose(table, CONSTRAINTS, FRAGMENTS).associate_with_seeds(
+                K_LIST, [1, 2, 3], 2, group_orders=['first', 'fullest', 'emptiest'])
+            self.assertIn(seed, [1, 2, 3])
+            self.check(table, associations, dropped)
+
+    def test_generated_on_demand(self):
+        # the rows of an unseeded generated table are generated by the process reading them
+        for associate in (lambda loose: loose.associate_in_parallel(K_LIST, 2),
+                          lambda loose: loose.associate_with_seeds(K_LIST, [1, 2], 2)[:2]):
+            table = RandomTable(self.TUPLES, 4)
+            associations, dropped = associate(Loose(table, CONSTRAINTS, FRAGMENTS))
+            self.check(table, associations, dropped)
+
+    def test_warm_start(self):
+        for table in self.tables:
+            previous, _ = Loose(table, CONSTRAINTS, FRAGMENTS).associate([2, 2])
+            previous = dict((row_id, association) for row_id, association in previous.iteritems() if association)
+            associations, dropped = Loose(table, CONSTRAINTS, FRAGMENTS).warm_start(K_LIST, previous)
+            self.check(table, associations, dropped)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+from exporter import Exporter
+from loose import Loose
+from querier import Querier, QuerierPool
+from tables import ListTable, RandomTable
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+
+FRAGMENTS = [[0, 2], [1, 3]]
+
+QUERIES = ['SELECT ?attr_0, ?attr_1 FROM ? WHERE ?attr_0 = 5',
+           'SELECT ?attr_0, ?attr_1, ?attr_3 FROM ? WHERE ?attr_0 = 5 AND ?attr_1 < 30 ORDER BY ?attr_1',
+           'SELECT ?attr_1, COUNT(*) FROM ? WHERE ?attr_2 > 25 AND ?attr_0 < 10 GROUP BY ?attr_1',
+           'SELECT ?attr_0, ?attr_1 FROM ? WHERE ?attr_0 = 5 OR ?attr_1 = 7',
+           "SELECT ?attr_0 FROM ? WHERE ?attr_0 = 3 AND ?attr_1 != 'a where b'"]
+
+COUNTS = ['SELECT ?attr_0, COUNT(*) FROM ? GROUP BY ?attr_0',
+          'SELECT ?attr_1, ?attr_2, COUNT(*) FROM ? GROUP BY ?attr_1, ?attr_2']
+
+
+class QuerierTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.INFO)
+        random.seed(5)
+        table = RandomTable(600, 4, maxvalue=60)
+        self.table = ListTable(table.attributes, [table[i] for i in xrange(600)])
+        associations, _ = Loose(self.table, [[0, 1], [2, 3]], FRAGMENTS).associate([3, 3])
+        self.exporter = Exporter(self.table, FRAGMENTS, associations)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.directory)
+
+    def joined(self, querier, sql):
+        '''returns the rows of sql on the whole joined table, without pushing the predicates down'''
+        joined = querier._get_joined_table(set(xrange(len(FRAGMENTS))))
+        return sorted(querier._cursor.execute(sql.replace('? ', joined + ' ').replace('?', '')).fetchall())
+
+    def test_pushdown(self):
+        querier = Querier(self.exporter.to_sqlite(sqlite3.connect(':memory:')), logger=None)
+        for sql in QUERIES:
+            self.assertEqual(sorted(querier.query(sql)), self.joined(querier, sql))
+
+    def test_summaries(self):
+        plain = Querier(self.exporter.to_sqlite(sqlite3.connect(':memory:')), logger=None)
+        summarized = Querier(self.exporter.to_sqlite(sqlite3.connect(':memory:'), summaries=True), logger=None)
+        for sql in COUNTS:
+            self.assertEqual(sorted(summarized.query(sql)), sorted(plain.query(sql)))
+            self.assertIn('summary_', summarized._cache[sql][0])
+
+    def test_exports(self):
+        tables = ('associations', 'fragment_0', 'fragment_1', 'schema')
+        exported = []
+        for name, kwargs in (('plain', {}), ('bulk', dict(bulk=True)), ('parallel', dict(processes=2))):
+            path = os.path.join(self.directory, name + '.db')
+            self.exporter.to_sqlite(path, **kwargs).close()
+            database = sqlite3.connect(path)
+            exported.append([sorted(database.execute('SELECT * FROM %s' % table)) for table in tables])
+        self.assertEqual(exported[1], exported[0])
+        self.assertEqual(exported[2], exported[0])
+        self.assertEqual(sorted(os.listdir(self.directory)), ['bulk.db', 'parallel.db', 'plain.db'])
+
+    def test_budget_and_pool(self):
+        path = os.path.join(self.directory, 'pool.db')
+        self.exporter.to_sqlite(path).close()
+        expected = dict((sql, sorted(Querier(path, logger=None).query(sql))) for sql in QUERIES)
+        # a budget smaller than a joined table evicts the tables at every query
+        pool = QuerierPool(path, 2, logger=None, budget=10, index_threshold=2)
+        for sql in QUERIES * 2:
+            self.assertEqual(sorted(pool.query(sql)), expected[sql])
+        self.assertEqual(pool.stats()['queries'], len(QUERIES) * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
-from itertools import izip_longest, product, chain
+from itertools import izip_longest, product, chain, islice
+from multiprocessing import Pool
 from random import shuffle, gauss
 from time import time
 
@@ -70,7 +71,24 @@ def placeholders(n):
     '''generate a placeholder with n fields for the DB-API executemany method'''
     return ', '.join(('?',) * n)
 
+def batches(iterable, size):
+    '''returns an iterator over lists of (at most) size consecutive elements of iterable'''
+    iterator = iter(iterable)
+    return iter(lambda: list(islice(iterator, size)), [])
+
 def make_withtime():
     '''return a function prepending the time passed from now to a string'''
     started = time()
     return lambda string: '[{:.2f}s] {}'.format(time() - started, string)
+
+_forked_state = None
+
+def forked_pool(processes, state):
+    '''return a Pool whose workers inherit state by forking, without pickling it'''
+    global _forked_state
+    _forked_state = state
+    return Pool(processes)
+
+def forked_state():
+    '''return the state shared with the workers of the last forked_pool'''
+    return _forked_state
@@ -0,0 +1,36 @@
+from heapq import heappush, heappop
+from itertools import count
+
+
+class Worklist:
+    '''Priority queue of keyed operations (lowest priority first, then last pushed first).
+
+    Pushing a key which is already pending does not add a new operation: it can only
+    raise the priority of the pending one, keeping its value.'''
+
+    def __init__(self):
+        self._heap = []
+        self._pending = {}
+        self._counter = count()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def push(self, key, priority, value):
+        '''returns False if the operation was coalesced with a pending one'''
+        coalesced = key in self._pending
+        if coalesced:
+            pending_priority, value = self._pending[key]
+            if pending_priority <= priority:
+                return False
+        self._pending[key] = priority, value
+        heappush(self._heap, (priority, -next(self._counter), key))
+        return not coalesced
+
+    def pop(self):
+        '''returns the key, the priority and the value of the most urgent operation'''
+        while True:
+            priority, _, key = heappop(self._heap)
+            # skip the entries superseded by a later push with a higher priority
+            if key in self._pending and self._pending[key][0] == priority:
+                return (key, priority) + (self._pending.pop(key)[1],)